@@ -3,20 +3,12 @@ from pathlib import Path
 from flask_sqlalchemy import SQLAlchemy
 from appdirs import user_data_dir
 
-from numcodecs import compat_ext  # Needed for pyinstaller
-from numcodecs import blosc  # Needed for pyinstaller
-import xmlschema  # Needed for pyinstaller
-
 import os
 import json
 import sys
+import threading
 import multiprocessing
 
-# Initialize sklearn global threadpool controller to avoid deadlock in threaded
-# contexts.
-import sklearn.utils.fixes
-sklearn.utils.fixes.threadpool_limits()
-
 # If you're running the pyinstaller version of the code, create a
 # new directory for the data (this will be at ~/ on mac)
 
@@ -25,6 +17,9 @@ cwd_path = Path.cwd()
 
 ## uncomment block if not on O2
 if getattr(sys, 'frozen', False):
+    from numcodecs import compat_ext  # Needed for pyinstaller
+    from numcodecs import blosc  # Needed for pyinstaller
+    import xmlschema  # Needed for pyinstaller
     data_path = Path(Path(sys.executable).parent / 'data')
     multiprocessing.freeze_support()
 else:
@@ -45,22 +40,73 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(data_path) + '/db.sqlite3'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['CLIENT_PATH'] = app.root_path + '/client/'
+# Loaded datasets are evicted, least recently used first, once together they hold more memory than this
+app.config['DATASET_MEMORY_BUDGET'] = int(float(os.environ.get('MINERVA_DATASET_MEMORY_BUDGET_GB', 8)) * 1024 ** 3)
+# Memory each dataset may use to keep recently used table columns resident
+app.config['HOT_COLUMN_BUDGET'] = int(float(os.environ.get('MINERVA_HOT_COLUMN_BUDGET_GB', 2)) * 1024 ** 3)
+# Store marker intensities as float32, IDs as uint32 and text columns as categoricals
+app.config['COMPACT_CELL_TABLE'] = os.environ.get('MINERVA_COMPACT_CELL_TABLE', '').lower() in ('yes', 'true', 't', '1')
+# Rows of a feature table CSV parsed (and held in memory) at a time when it is imported or transformed
+app.config['CSV_CHUNK_ROWS'] = int(os.environ.get('MINERVA_CSV_CHUNK_ROWS', 250000))
+# Build sorted indexes of gated channels (on disk, next to the column cache) to answer selective gates
+app.config['CHANNEL_INDEXES'] = os.environ.get('MINERVA_CHANNEL_INDEXES', 'true').lower() in ('yes', 'true', 't', '1')
+# Seconds browsers may reuse image tiles before revalidating them (by ETag)
+app.config['TILE_MAX_AGE'] = int(os.environ.get('MINERVA_TILE_MAX_AGE', 7 * 24 * 3600))
 config_json_path = data_path / "config.json"
 db = SQLAlchemy(app)
 
 
+# Parsed config.json, reused until the file's mtime or size changes
+_config_cache = {'key': None, 'data': None}
+_config_lock = threading.Lock()
+
+
 def get_config():
+    # The returned dict is shared, copy it before changing it and pass the copy to write_config
     if not Path.is_dir(data_path):
         Path.mkdir(data_path)
 
     if not Path.is_file(config_json_path):
-        with open(config_json_path, 'w') as f:
-            json.dump({}, f)
-            return []
-    else:
-        with open(config_json_path, 'r+') as f:
-            data = json.load(f)
-    return data
+        write_config({})
+        return []
+    with _config_lock:
+        stat = os.stat(config_json_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if _config_cache['key'] != key:
+            with open(config_json_path, 'r') as f:
+                _config_cache['data'] = json.load(f)
+            _config_cache['key'] = key
+        return _config_cache['data']
+
+
+def write_config(data):
+    # Writes to a temporary file first so readers never see a partially written config
+    with _config_lock:
+        tmp_path = config_json_path.with_name(config_json_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, config_json_path)
+        stat = os.stat(config_json_path)
+        _config_cache['key'] = (stat.st_mtime_ns, stat.st_size)
+        _config_cache['data'] = data
+
+
+# Heavy libraries are imported where they are first used. Importing packages
+# with circular imports (sklearn, scipy) from two threads at once can fail, so
+# those deferred imports are made while holding this lock.
+import_lock = threading.RLock()
+_sklearn_initialized = False
+
+
+def init_sklearn():
+    # Initialize sklearn global threadpool controller to avoid deadlock in
+    # threaded contexts, once sklearn is first used.
+    global _sklearn_initialized
+    with import_lock:
+        if not _sklearn_initialized:
+            import sklearn.utils.fixes
+            sklearn.utils.fixes.threadpool_limits()
+            _sklearn_initialized = True
 
 
 def get_config_names():
@@ -333,6 +333,142 @@ class DataLayer {
         }
     }
 
+    async getGatedCellIdsBinary(filter, start_keys, combine = 'and') {
+        try {
+            let response = await fetch('/get_gated_cell_ids_binary?' + new URLSearchParams({
+                filter: JSON.stringify(filter),
+                start_keys: start_keys,
+                combine: combine,
+                datasource: datasource
+            }))
+            let buffer = await response.arrayBuffer();
+            return new Uint32Array(buffer);
+        } catch (e) {
+            console.log("Error Getting Gated Cell Ids", e);
+        }
+    }
+
+    async getGatedCellCount(filter, combine = 'and', exact = false) {
+        try {
+            let response = await fetch('/get_gated_cell_count?' + new URLSearchParams({
+                filter: JSON.stringify(filter),
+                combine: combine,
+                exact: exact,
+                datasource: datasource
+            }))
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Gated Cell Count", e);
+        }
+    }
+
+    async getGatedCellSets(gate_sets, combine = 'and', labels = false) {
+        try {
+            let response = await fetch('/get_gated_cell_sets', {
+                method: 'POST',
+                headers: {
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(
+                    {
+                        datasource: datasource,
+                        gate_sets: gate_sets,
+                        combine: combine,
+                        labels: labels
+                    }
+                )
+            });
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Gated Cell Sets", e);
+        }
+    }
+
+    async getGatingTreeCounts(nodes, encoding = null) {
+        try {
+            let response = await fetch('/get_gating_tree_counts', {
+                method: 'POST',
+                headers: {
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(
+                    {
+                        datasource: datasource,
+                        nodes: nodes,
+                        encoding: encoding
+                    }
+                )
+            });
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Gating Tree Counts", e);
+        }
+    }
+
+    async saveGatingTree(nodes, name = 'default') {
+        try {
+            let response = await fetch('/save_gating_tree', {
+                method: 'POST',
+                headers: {
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(
+                    {
+                        datasource: datasource,
+                        name: name,
+                        nodes: nodes
+                    }
+                )
+            });
+            return await response.json();
+        } catch (e) {
+            console.log("Error Saving Gating Tree", e);
+        }
+    }
+
+    async getSavedGatingTree(name = 'default') {
+        try {
+            let response = await fetch('/get_saved_gating_tree?' + new URLSearchParams({
+                name: name,
+                datasource: datasource
+            }))
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Saved Gating Tree", e);
+        }
+    }
+
+    // The start_keys and gated columns of the gated cells as one typed array per key
+    async getGatedCellsColumnar(filter, start_keys) {
+        const arrayTypes = {
+            float32: Float32Array, float64: Float64Array, int8: Int8Array, uint8: Uint8Array,
+            int16: Int16Array, uint16: Uint16Array, int32: Int32Array, uint32: Uint32Array,
+            int64: BigInt64Array, uint64: BigUint64Array
+        };
+        try {
+            let response = await fetch('/get_gated_cell_ids_custom?' + new URLSearchParams({
+                filter: JSON.stringify(filter),
+                start_keys: start_keys,
+                format: 'binary',
+                datasource: datasource
+            }))
+            let buffer = await response.arrayBuffer();
+            let headerLength = new DataView(buffer).getUint32(0, true);
+            let header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+            let columns = {};
+            header.columns.forEach(column => {
+                columns[column.name] = new arrayTypes[column.dtype](buffer, 4 + headerLength + column.offset,
+                    header.count);
+            });
+            return columns;
+        } catch (e) {
+            console.log("Error Getting Gated Cells", e);
+        }
+    }
+
     async getGatedCellIdsCustom(filter, start_keys) {
         try {
             // const start = performance.now()
@@ -439,16 +575,109 @@ class DataLayer {
     }
 
     async getNearestCell(point_x, point_y) {
+        let cells = await this.getNearestCellRecords([[point_x, point_y]]);
+        if (!cells || cells[0].length === 0) {
+            return {};
+        }
+        let cell = cells[0][0];
+        if (!('celltype' in cell)) {
+            cell.celltype = '';
+        }
+        return cell;
+    }
+
+    // The k nearest cells of each [x, y] point, nearest first, as objects of columns (['*'] for all)
+    async getNearestCellRecords(points, k = 1, maxDistance = null, columns = ['*']) {
         try {
-            let response = await fetch('/get_nearest_cell?' + new URLSearchParams({
-                point_x: point_x,
-                point_y: point_y,
-                datasource: datasource
-            }))
-            let cell = await response.json();
-            return cell;
+            let params = {
+                datasource: datasource,
+                points: points,
+                k: k,
+                columns: columns,
+                format: 'json'
+            };
+            if (maxDistance !== null) {
+                params.max_distance = maxDistance;
+            }
+            let response = await fetch('/get_nearest_cells', {
+                method: 'POST',
+                headers: {
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(params)
+            });
+            let result = await response.json();
+            let names = Object.keys(result.columns);
+            return points.map((point, i) => {
+                let cells = [];
+                for (let j = i * result.k; j < (i + 1) * result.k; j++) {
+                    if (result.rows[j] < 0) {
+                        continue;
+                    }
+                    let cell = {};
+                    names.forEach(name => {
+                        cell[name] = result.columns[name][j];
+                    });
+                    cells.push(cell);
+                }
+                return cells;
+            });
         } catch (e) {
-            console.log("Error Getting Nearest Cell", e);
+            console.log("Error Getting Nearest Cells", e);
+        }
+    }
+
+    async getNearestCells(points, k = 1, columns = [], maxDistance = null) {
+        // points is a Float32Array of x, y pairs
+        try {
+            let params = {
+                datasource: datasource,
+                k: k,
+                columns: columns.join(','),
+                format: 'binary'
+            };
+            if (maxDistance !== null) {
+                params.max_distance = maxDistance;
+            }
+            let response = await fetch('/get_nearest_cells?' + new URLSearchParams(params), {
+                method: 'POST',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: points
+            });
+            let buffer = await response.arrayBuffer();
+            let size = points.length / 2 * k;
+            let result = {
+                rows: new Int32Array(buffer, 0, size),
+                distances: new Float32Array(buffer, size * 4, size),
+                columns: {}
+            };
+            columns.forEach((column, i) => {
+                result.columns[column] = new Float32Array(buffer, size * 4 * (i + 2), size);
+            });
+            return result;
+        } catch (e) {
+            console.log("Error Getting Nearest Cells", e);
+        }
+    }
+
+    async getLodCells(level, viewport = null, mode = 'sample', columns = []) {
+        // viewport is [x0, y0, x1, y1] in image pixels, the whole image if null
+        try {
+            let params = {
+                datasource: datasource,
+                level: level,
+                mode: mode,
+                columns: columns.join(',')
+            };
+            if (viewport !== null) {
+                params.viewport = viewport.join(',');
+            }
+            let response = await fetch('/get_lod_cells?' + new URLSearchParams(params));
+            let cells = await response.json();
+            return cells;
+        } catch (e) {
+            console.log("Error Getting LOD Cells", e);
         }
     }
 
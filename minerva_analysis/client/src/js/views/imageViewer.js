@@ -366,6 +366,20 @@ class ImageViewer {
             this.eventHandler.trigger(ImageViewer.events.addScaleBar);
         });
 
+        // Add listener for the cell overview, redrawn for the viewport after every pan or zoom
+        this.show_cell_overview = false;
+        this.cellOverviewRequest = 0;
+        const controls_cell_overview = document.querySelector("#controls_cell_overview");
+        if (controls_cell_overview) {
+            controls_cell_overview.addEventListener("change", (e) => {
+                this.show_cell_overview = e.target.checked;
+                this.drawCellOverview();
+            });
+        }
+        this.viewer.addHandler("animation-finish", () => {
+            this.drawCellOverview();
+        });
+
         // Add event mouse handler (cell selection)
         this.viewer.addHandler("canvas-nonprimary-press", (e) => {
             // Right click (cell selection)
@@ -1370,6 +1384,53 @@ class ImageViewer {
         this.forceRepaint();
     }
 
+    /**
+     * @function drawCellOverview - draws the cells in view from the server's centroid pyramid, one circle per bin
+     * of a few screen pixels (its area by the number of cells), instead of every cell
+     */
+    async drawCellOverview() {
+        const request = ++this.cellOverviewRequest;
+        if (!this.show_cell_overview) {
+            this.overlay.select('#cell_overview').remove();
+            return;
+        }
+        const tiledImage = this.viewer.world.getItemAt(0);
+        const zoomScale = 2 ** config.extraZoomLevels;
+        const bounds = this.viewer.viewport.getBounds(true);
+        const topLeft = tiledImage.viewportToImageCoordinates(bounds.getTopLeft());
+        const bottomRight = tiledImage.viewportToImageCoordinates(bounds.getBottomRight());
+        const viewport = [topLeft.x / zoomScale, topLeft.y / zoomScale,
+            bottomRight.x / zoomScale, bottomRight.y / zoomScale];
+        // The pyramid level matching the image level shown: 2 ** level image pixels per screen pixel
+        const pixelsPerScreen = (viewport[2] - viewport[0]) / this.viewer.viewport.getContainerSize().x;
+        const level = Math.max(0, Math.floor(Math.log2(pixelsPerScreen)));
+
+        const cells = await this.dataLayer.getLodCells(level, viewport, 'aggregate');
+        // Skip responses overtaken by a later pan, zoom or toggle
+        if (!cells || request !== this.cellOverviewRequest) {
+            return;
+        }
+        const toViewport = (x, y) => tiledImage.imageToViewportCoordinates(x * zoomScale, y * zoomScale);
+        const binRadius = (toViewport(cells.bin_size, 0).x - toViewport(0, 0).x) / 2;
+        const maxCount = cells.count.reduce((a, b) => Math.max(a, b), 1);
+        const bins = cells.count.map((count, i) => {
+            const center = toViewport(cells.x[i], cells.y[i]);
+            return {x: center.x, y: center.y, r: binRadius * Math.sqrt(count / maxCount)};
+        });
+
+        this.overlay.select('#cell_overview').remove();
+        this.overlay.append('g')
+            .attr('id', 'cell_overview')
+            .selectAll('circle')
+            .data(bins)
+            .enter()
+            .append('circle')
+            .attr('class', 'cell_overview_bin')
+            .attr('cx', d => d.x)
+            .attr('cy', d => d.y)
+            .attr('r', d => d.r);
+    }
+
     addScaleBar() {
         let pixelsPerMeter;
         if(this.imgMetadata) {
@@ -8,6 +8,9 @@ export class LfNearestCells {
     load = [];
     vars = {
         cellIntensityRange: [0, 65536],
+        // Cells fetched for the lens at most, the nearest ones; when reached the report says so
+        maxCells: 2000,
+        capped: false,
         config_colorR: 4,
         config_boxW: 240,
         config_boxH: 50,
@@ -95,9 +98,16 @@ export class LfNearestCells {
                             // Get position of cell and add to data
                             const pos = lensing.configs.pos_full;
 
+                            // Only the coordinates and the selected channels are rendered
+                            const columns = _.uniq([this.data_layer.x, this.data_layer.y].concat(
+                                this.channel_list.selections.map(c => this.data_layer.getFullChannelName(c))));
+
                             // Load
                             this.load.config.filterCode.settings.loading = true;
-                            this.data_layer.getNeighborhood(newRad, pos[0], pos[1]).then(darr => {
+                            this.data_layer.getNearestCellRecords([[pos[0], pos[1]]], this.vars.maxCells, newRad,
+                                columns).then(cells => {
+                                const darr = cells ? cells[0] : [];
+                                this.vars.capped = darr.length >= this.vars.maxCells;
 
                                 // Loaded
                                 this.load.config.filterCode.settings.loading = false;
@@ -120,7 +130,7 @@ export class LfNearestCells {
                                 // Iterate data array
                                 darr.forEach(d => {
                                     // Calc offset
-                                    const cell_point = new OpenSeadragon.Point(d.CellPosition_X, d.CellPosition_Y);
+                                    const cell_point = new OpenSeadragon.Point(d[this.data_layer.x], d[this.data_layer.y]);
                                     const cell_vpoint = lensing.viewer_aux.viewport.pixelFromPoint(
                                         lensing.viewer_aux.world.getItemAt(0).imageToViewportCoordinates(cell_point)
                                     );
@@ -235,13 +245,13 @@ export class LfNearestCells {
 
                                     // Add channels
                                     if (this.data[0].data.hasOwnProperty(k) &&
-                                        channels.includes(k.split('_')[0])) {
+                                        channels.includes(this.data_layer.getShortChannelName(k))) {
                                         const map = this.data.map(c => c.data[k]);
                                         const sum = map.reduce((acc, cur) => acc + cur);
                                         this.vars.histRange.push({
                                             key: k,
                                             mean: sum / map.length,
-                                            short_name: k.split('_')[0],
+                                            short_name: this.data_layer.getShortChannelName(k),
                                             values: map
                                         });
                                     }
@@ -457,6 +467,9 @@ export class LfNearestCells {
                             // Update cell count
                             this.vars.el_textReportG.select('.viewfinder_text_report_text2')
                                 .text(() => {
+                                    if (this.vars.capped) {
+                                        return `Cell count: ${this.data.length} (nearest ${this.vars.maxCells} only)`;
+                                    }
                                     if (this.data.length > 0) return `Cell count: ${this.data.length}`;
                                     return '';
                                 })
@@ -1,172 +1,225 @@
-from sklearn.neighbors import BallTree
-from sklearn.preprocessing import MinMaxScaler
 import numpy as np
 import pandas as pd
-from PIL import ImageColor
+from PIL import Image, ImageColor
+import base64
+import hashlib
 import json
+import copy
 import os
 import io
 from pathlib import Path
 from pathlib import PurePath
-from ome_types import from_xml
-from minerva_analysis import config_json_path, data_path, cwd_path
-from minerva_analysis.server.utils import pyramid_assemble, pyramid_upgrade
+from minerva_analysis import app, data_path, cwd_path, get_config, write_config, import_lock, init_sklearn
 from minerva_analysis.server.models import database_model
+from minerva_analysis.server.models.dataset_registry import DatasetRegistry
 from minerva_analysis.server.utils import smallestenclosingcircle
-import matplotlib.path as mpltPath
+from minerva_analysis.server.utils import column_cache
+from minerva_analysis.server.utils import spatial_index
+from minerva_analysis.server.utils import fingerprint
+from minerva_analysis.server.utils import density
+from minerva_analysis.server.utils import lod_pyramid
+from minerva_analysis.server.utils import gating
+from minerva_analysis.server.utils import channel_index
+from minerva_analysis.server.utils import histograms
+from minerva_analysis.server.utils.cellset import CellSet
 from itertools import chain
 import dateutil.parser
 import time
 import pickle
-import tifffile as tf
 import re
-import zarr
-import cv2
-from sklearn.mixture import GaussianMixture
-from scipy.stats import norm
-from skimage.measure import block_reduce
-
-ball_tree = None
-database = None
-source = None
-config = None
-seg = None
-zarray = None
-channels = None
-metadata = None
-
-
-def init(datasource_name):
-    load_ball_tree(datasource_name)
+import threading
+import concurrent.futures
 
+config = None
+# Held while a centroid pyramid is built, so concurrent requests build it once
+lod_lock = threading.Lock()
+# Held while the sorted indexes of a dataset are looked up
+channel_index_lock = threading.Lock()
+# Builds missing sorted indexes one at a time, in the background
+channel_index_builder = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='channel-index')
+# Held while cumulative histograms are built
+histogram_lock = threading.Lock()
+
+
+def init(datasource_name, reload=False):
+    # Starts loading in the background, progress is reported by get_load_status
+    return datasets.start(datasource_name, reload=reload).status()
+
+
+def get_load_status(datasource_name):
+    return datasets.status(datasource_name)
+
+
+def load_datasource(datasource_name, reload=False, phase='overview'):
+    # Waits until the dataset has been loaded up to (and including) phase
+    return datasets.get(datasource_name, reload=reload, phase=phase)
+
+
+def unload_datasource(datasource_name):
+    datasets.discard(datasource_name)
+
+
+def get_loaded_datasources():
+    return datasets.report()
+
+
+def read_datasource(dataset, reload=False):
+    # Image libraries are imported here rather than at startup, they are slow to load
+    with import_lock:
+        import tifffile as tf
+        import zarr
+        from ome_types import from_xml
+        from skimage.measure import block_reduce
+
+    datasource_name = dataset.name
+    # A failed load resumes here, the phases it completed are not loaded again
+    if dataset.needs('config'):
+        with dataset.loading_phase('config'):
+            load_config(datasource_name)
+    # The table is parsed once; the spatial index is built from its coordinate columns
+    if dataset.needs('table'):
+        with dataset.loading_phase('table'):
+            csvPath = Path(config[datasource_name]['featureData'][0]['src'])
+            cache_dir = Path(cwd_path, data_path, datasource_name, 'column_cache')
+            feature_data = config[datasource_name]['featureData'][0]
+            coordinates = [feature_data['xCoordinate'], feature_data['yCoordinate']]
+            compact = app.config['COMPACT_CELL_TABLE']
+
+            def prepare(df):
+                df = column_cache.clean_infinities(df)
+                if compact:
+                    # Coordinates keep full precision for the spatial index
+                    df = column_cache.compact_dtypes(df, keep=coordinates)
+                return df
+
+            # Only coordinates and IDs are read up front, other columns on first use
+            # Converted to the column cache a chunk of rows at a time, so tables larger than memory can be loaded
+            dataset.table = column_cache.load(csvPath, cache_dir, prepare=prepare, options={'compact': compact},
+                                              hot_bytes=app.config['HOT_COLUMN_BUDGET'],
+                                              pinned=coordinates + [get_id_field(datasource_name)],
+                                              chunk_rows=app.config['CSV_CHUNK_ROWS'],
+                                              progress=dataset.report_progress)
+    # Derived artifacts are rebuilt when their inputs changed, also on reload
+    if dataset.needs('spatial_index'):
+        with dataset.loading_phase('spatial_index'):
+            load_spatial_index(dataset)
+    if dataset.needs('segmentation'):
+        with dataset.loading_phase('segmentation'):
+            print("Loading segmentation.")
+            if config[datasource_name]['segmentation'].endswith('.zarr'):
+                dataset.seg = zarr.load(config[datasource_name]['segmentation'])
+            else:
+                seg_io = tf.TiffFile(config[datasource_name]['segmentation'], is_ome=False)
+                dataset.seg = zarr.open(seg_io.series[0].aszarr())
+    if dataset.needs('channels'):
+        with dataset.loading_phase('channels'):
+            channel_io = tf.TiffFile(config[datasource_name]['channelFile'], is_ome=False)
+            print("Loading image descriptions.")
+            try:
+                xml = channel_io.pages[0].tags['ImageDescription'].value
+                dataset.metadata = from_xml(xml).images[0].pixels
+            except:
+                dataset.metadata = {}
+            dataset.channels = zarr.open(channel_io.series[0].aszarr())
+    if dataset.needs('overview'):
+        with dataset.loading_phase('overview'):
+            overview_path = Path(cwd_path, data_path, datasource_name, 'overview.npy')
+            overview_inputs = fingerprint.describe([config[datasource_name]['channelFile']])
+            if fingerprint.is_current(overview_path, overview_inputs):
+                dataset.zarray = np.load(overview_path, allow_pickle=False)
+            else:
+                with tf.TiffFile(config[datasource_name]['channelFile'], is_ome=False) as overview_io:
+                    level_series = next(
+                        level for level in reversed(overview_io.series[0].levels)
+                        if all(d >= 200 for d in level.shape[1:])
+                    )
+                    zarray = zarr.open(level_series.aszarr())
+                    if zarray.shape[1] > 400 or zarray.shape[2] > 400:
+                        x_reduce = zarray.shape[1] // 200
+                        y_reduce = zarray.shape[2] // 200
+                        reduce = np.min([x_reduce, y_reduce])
+                        zarray = block_reduce(zarray, (1, reduce, reduce), np.mean)
+                    dataset.zarray = np.asarray(zarray)
+                np.save(overview_path, dataset.zarray, allow_pickle=False)
+                fingerprint.write(overview_path, overview_inputs)
 
-def load_datasource(datasource_name, reload=False):
-    global datasource
-    global source
-    global config
-    global seg
-    global zarray
-    global channels
-    global metadata
-    if source is datasource_name and datasource is not None and reload is False:
-        return
-    load_config(datasource_name)
-    if reload:
-        load_ball_tree(datasource_name, reload=reload)
-    csvPath = Path(config[datasource_name]['featureData'][0]['src'])
-    print("Loading csv data.. (this can take some time)")
-    datasource = pd.read_csv(csvPath)
-    datasource['id'] = datasource.index
-    datasource = datasource.replace(-np.Inf, 0)
-    source = datasource_name
-    print("Loading segmentation.")
-    if config[datasource_name]['segmentation'].endswith('.zarr'):
-        seg = zarr.load(config[datasource_name]['segmentation'])
-    else:
-        seg_io = tf.TiffFile(config[datasource_name]['segmentation'], is_ome=False)
-        seg = zarr.open(seg_io.series[0].aszarr())
-    channel_io = tf.TiffFile(config[datasource_name]['channelFile'], is_ome=False)
-    print("Loading image descriptions.")
-    try:
-        xml = channel_io.pages[0].tags['ImageDescription'].value
-        metadata = from_xml(xml).images[0].pixels
-    except:
-        metadata = {}
-    channels = zarr.open(channel_io.series[0].aszarr())
+    print("Data loading done (" + ", ".join("%s %.2fs" % item for item in dataset.timings.items()) + ").")
 
-    level_series = next(
-        level for level in reversed(channel_io.series[0].levels)
-        if all(d >= 200 for d in level.shape[1:])
-    )
-    zarray = zarr.open(level_series.aszarr())
-    if zarray.shape[1] > 400 or zarray.shape[2] > 400:
-        x_reduce = zarray.shape[1] // 200
-        y_reduce = zarray.shape[2] // 200
-        reduce = np.min([x_reduce, y_reduce])
-        zarray = block_reduce(zarray, (1, reduce, reduce), np.mean)
 
-    print("Data loading done.")
+datasets = DatasetRegistry(read_datasource, app.config['DATASET_MEMORY_BUDGET'])
 
 
 def load_config(datasource_name):
     global config
 
-    with open(config_json_path, "r+") as configJson:
-        config = json.load(configJson)
-        updated = False
-        # Update Feature SRC
-        original = config[datasource_name]['featureData'][0]['src']
-        config[datasource_name]['featureData'][0]['src'] = original.replace('static/data', 'minerva_analysis/data')
-        csvPath = config[datasource_name]['featureData'][0]['src']
-        if Path(csvPath).exists() is False:
-            if Path('.' + csvPath).exists():
-                csvPath = '.' + csvPath
-        config[datasource_name]['featureData'][0]['src'] = str(Path(csvPath))
-        if original != config[datasource_name]['featureData'][0]['src']:
-            updated = True
-
-        try:
-            original = config[datasource_name]['segmentation']
-            config[datasource_name]['segmentation'] = original.replace('static/data', 'minerva_analysis/data')
-            if original != config[datasource_name]['segmentation']:
-                updated = True
+    config = get_config()
+    dataset_config = copy.deepcopy(config[datasource_name])
+    updated = False
+    # Update Feature SRC
+    original = dataset_config['featureData'][0]['src']
+    csvPath = original.replace('static/data', 'minerva_analysis/data')
+    if Path(csvPath).exists() is False:
+        if Path('.' + csvPath).exists():
+            csvPath = '.' + csvPath
+    dataset_config['featureData'][0]['src'] = str(Path(csvPath))
+    if original != dataset_config['featureData'][0]['src']:
+        updated = True
 
-        except KeyError:
-            print(datasource_name, 'is  missing segmentation')
+    try:
+        original = dataset_config['segmentation']
+        dataset_config['segmentation'] = original.replace('static/data', 'minerva_analysis/data')
+        if original != dataset_config['segmentation']:
+            updated = True
 
-        if updated:
-            configJson.seek(0)  # <--- should reset file position to the beginning.
-            json.dump(config, configJson, indent=4)
-            configJson.truncate()
+    except KeyError:
+        print(datasource_name, 'is  missing segmentation')
 
+    if updated:
+        config = dict(config)
+        config[datasource_name] = dataset_config
+        write_config(config)
 
-def load_ball_tree(datasource_name_name, reload=False):
-    global ball_tree
-    global datasource
-    global config
-    if datasource_name_name != source:
-        load_datasource(datasource_name_name)
 
-    # old with os.path
-    # pickled_kd_tree_path = str(
-    #     Path(
-    #         os.path.join(os.getcwd())) / data_path / datasource_name_name / "ball_tree.pickle")
+def table_fingerprint(dataset, columns, files=(), **params):
+    # Inputs of an artifact derived from columns of the feature table (and other files)
+    source = dataset.table.source
+    source = dict(source) if source is not None else config[dataset.name]['featureData'][0]['src']
+    return fingerprint.describe([source] + list(files), columns, **params)
 
-    #using pathlib now:
-    pickled_kd_tree_path = str(
-        PurePath(cwd_path, data_path, datasource_name_name, "ball_tree.pickle"))
 
-    #old os.path way:  if os.path.isfile(pickled_kd_tree_path) and reload is False:
-    if Path(pickled_kd_tree_path).is_file() and reload is False:
+def load_spatial_index(dataset):
+    datasource_name = dataset.name
+    table = dataset.table
 
-        print("Pickled KD Tree Exists, Loading")
-        ball_tree = pickle.load(open(pickled_kd_tree_path, "rb"))
-        print("Pickled KD Tree Loaded.")
+    xCoordinate = config[datasource_name]['featureData'][0]['xCoordinate']
+    yCoordinate = config[datasource_name]['featureData'][0]['yCoordinate']
+    index_dir = Path(cwd_path, data_path, datasource_name, 'spatial_index')
+    inputs = table_fingerprint(dataset, [xCoordinate, yCoordinate])
+    dataset.spatial_index = spatial_index.load(index_dir) if fingerprint.is_current(index_dir, inputs) else None
+    if dataset.spatial_index is not None:
+        print("Spatial index loaded.")
     else:
-        print("Creating KD Tree.")
-        xCoordinate = config[datasource_name_name]['featureData'][0]['xCoordinate']
-        yCoordinate = config[datasource_name_name]['featureData'][0]['yCoordinate']
-        csvPath = Path(config[datasource_name_name]['featureData'][0]['src'])
-        raw_data = pd.read_csv(csvPath)
-        points = pd.DataFrame({'x': raw_data[xCoordinate], 'y': raw_data[yCoordinate]})
-        ball_tree = BallTree(points, metric='euclidean')
-        pickle.dump(ball_tree, open(pickled_kd_tree_path, 'wb'))
-        print('Creating KD Tree done.')
+        print("Creating spatial index.")
+        dataset.spatial_index = spatial_index.build(table.column(xCoordinate), table.column(yCoordinate), index_dir)
+        fingerprint.write(index_dir, inputs)
+        print('Creating spatial index done.')
+
+    # Replaced by the spatial index
+    pickled_kd_tree_path = Path(cwd_path, data_path, datasource_name, "ball_tree.pickle")
+    if pickled_kd_tree_path.is_file():
+        os.remove(pickled_kd_tree_path)
 
 
 def query_for_closest_cell(x, y, datasource_name):
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    distance, index = ball_tree.query([[x, y]], k=1)
-    if distance == np.inf:
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    table = dataset.table
+    distances, rows = dataset.spatial_index.nearest([[x, y]], k=1)
+    if distances[0, 0] == np.inf:
         return {}
     #         Nothing found
     else:
         try:
-            row = datasource.iloc[index[0]]
+            row = table.rows(rows[0])
             obj = row.to_dict(orient='records')[0]
             if 'celltype' not in obj:
                 obj['celltype'] = ''
@@ -175,22 +228,41 @@ def query_for_closest_cell(x, y, datasource_name):
             return {}
 
 
+def get_nearest_cells(datasource_name, points, k=1, columns=None, max_distance=None):
+    """
+    Nearest cells of many points in one query: rows and distances of the k
+    nearest cells of each of the (m, 2) points, each of shape (m, k), with row -1
+    and distance inf where there is no cell (within max_distance). values holds
+    the requested columns (all of them for ['*']) at the rows found, in
+    row-major order, columns lists their names.
+    """
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    table = dataset.table
+    if columns == ['*']:
+        columns = list(table.columns)
+    distances, rows = dataset.spatial_index.nearest(points, k=k)
+    if max_distance is not None:
+        too_far = distances > max_distance
+        rows[too_far] = -1
+        distances[too_far] = np.inf
+    found = rows >= 0
+    values = {}
+    if columns:
+        found_rows = table.rows(rows[found], columns)
+        values = {column: found_rows[column].to_numpy() for column in columns}
+    return {'rows': rows, 'distances': distances, 'found': found, 'values': values, 'columns': columns or []}
+
+
 def get_row(row, datasource_name):
-    global database
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    obj = database.loc[[row]].to_dict(orient='records')[0]
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    obj = table.rows([row]).to_dict(orient='records')[0]
     obj['id'] = row
     return obj
 
 
 def get_channel_names(datasource_name, shortnames=True):
-    global datasource
-    global source
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name, phase='config')
     if shortnames:
         channel_names = [channel['name'] for channel in config[datasource_name]['imageData'][1:]]
     else:
@@ -199,25 +271,15 @@ def get_channel_names(datasource_name, shortnames=True):
 
 
 def get_channel_cells(datasource_name, channels):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
-    query_string = ''
-    for c in channels:
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(range[0]) + ' < `' + c + '` < ' + str(range[1])
-    if query_string == None or query_string == "":
+    mask = gating.gates_mask(table, {c: range for c in channels}, cache=dataset.gate_masks)
+    if mask is None:
         return []
-    query = datasource.query(query_string)[['id']].to_dict(orient='records')
-    return query
+    return [{'id': id} for id in np.flatnonzero(mask).tolist()]
 
 
 def get_phenotype_description(datasource):
@@ -246,15 +308,10 @@ def get_phenotype_column_name(datasource):
 
 
 def get_cells_phenotype(datasource_name):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
     try:
         phenotype_field = config[datasource_name]['featureData'][0]['celltype']
@@ -263,13 +320,11 @@ def get_cells_phenotype(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    query = datasource[['id', phenotype_field]].to_dict(orient='records')
+    query = table.frame(['id', phenotype_field]).to_dict(orient='records')
     return query
 
 
 def get_phenotypes(datasource_name):
-    global datasource
-    global source
     global config
     try:
         phenotype_field = config[datasource_name]['featureData'][0]['celltype']
@@ -278,51 +333,123 @@ def get_phenotypes(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    if phenotype_field in datasource.columns:
-        return sorted(datasource[phenotype_field].unique().tolist())
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    if phenotype_field in table:
+        return sorted(pd.unique(table.column(phenotype_field)).tolist())
     else:
         return ['']
 
 
 def get_neighborhood(x, y, datasource_name, r=100, fields=None):
-    global database
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    neighbors = index[0]
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    table = dataset.table
+    neighbors = dataset.spatial_index.query_radius(x, y, r)
     try:
         if fields and len(fields) > 0:
             fields.append('id') if 'id' not in fields else fields
             if len(fields) > 1:
-                neighborhood = database.iloc[neighbors][fields].to_dict(orient='records')
+                neighborhood = table.rows(neighbors, fields).to_dict(orient='records')
             else:
-                neighborhood = database.iloc[neighbors][fields].to_dict()
+                neighborhood = table.rows(neighbors, fields).to_dict()
         else:
-            neighborhood = database.iloc[neighbors].to_dict(orient='records')
+            neighborhood = table.rows(neighbors).to_dict(orient='records')
 
         return neighborhood
     except:
         return {}
 
 
-def get_number_of_cells_in_circle(x, y, datasource_name, r):
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    try:
-        return len(index[0])
-    except:
-        return 0
+def get_number_of_cells_in_circle(x, y, datasource_name, r, exact=True, phenotype=None):
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    return get_density(dataset, phenotype).count_circle(x, y, r, exact=exact)
+
+
+def get_number_of_cells_in_rect(datasource_name, rect, exact=True, phenotype=None):
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    return get_density(dataset, phenotype).count_rect(*rect, exact=exact)
+
+
+def get_density(dataset, phenotype=None, key=None, mask=None):
+    """
+    Summed-area table counting all cells of the dataset, those of a phenotype,
+    or those selected by mask (a boolean array over rows) cached under key.
+    """
+    if phenotype is not None:
+        key = ('phenotype', phenotype)
+    table = dataset.densities.get(key)
+    if table is None:
+        if phenotype is not None:
+            field = get_phenotype_column_name(dataset.name) or 'celltype'
+            mask = dataset.table.column(field) == phenotype if field in dataset.table else \
+                np.zeros(len(dataset.table), dtype=bool)
+        table = density.DensityTable(dataset.spatial_index, mask)
+        dataset.densities.put(key, table, table.resident_bytes())
+    return table
+
+
+def load_lod_pyramid(dataset):
+    # The centroid pyramid is built on first use, not while the dataset loads
+    if dataset.lod_pyramid is not None:
+        return dataset.lod_pyramid
+    with lod_lock:
+        if dataset.lod_pyramid is not None:
+            return dataset.lod_pyramid
+        datasource_name = dataset.name
+        table = dataset.table
+        xCoordinate = config[datasource_name]['featureData'][0]['xCoordinate']
+        yCoordinate = config[datasource_name]['featureData'][0]['yCoordinate']
+        phenotype_field = get_phenotype_column_name(datasource_name) or 'celltype'
+        columns = [xCoordinate, yCoordinate] + ([phenotype_field] if phenotype_field in table else [])
+        pyramid_dir = Path(cwd_path, data_path, datasource_name, 'lod_pyramid')
+        inputs = table_fingerprint(dataset, columns, bin_pixels=lod_pyramid.BIN_PIXELS)
+        pyramid = lod_pyramid.load(pyramid_dir) if fingerprint.is_current(pyramid_dir, inputs) else None
+        if pyramid is None:
+            print("Creating centroid pyramid.")
+            phenotypes = table.column(phenotype_field) if phenotype_field in table else None
+            pyramid = lod_pyramid.build(table.column(xCoordinate), table.column(yCoordinate), pyramid_dir,
+                                        phenotypes)
+            fingerprint.write(pyramid_dir, inputs)
+            print("Creating centroid pyramid done.")
+        dataset.lod_pyramid = pyramid
+    return pyramid
+
+
+def get_lod_cells(datasource_name, level, viewport=None, mode='sample', columns=()):
+    """
+    Cells of the viewport [x0, y0, x1, y1] (the whole image if None) at image
+    pyramid level, one entry per non-empty bin of the centroid pyramid. In
+    'sample' mode an entry is the cell closest to the bin centre with the given
+    columns, in 'aggregate' mode the bin's mean centroid, most common phenotype
+    and the mean of the given columns over its cells. Both hold count, the number
+    of cells in the bin.
+    """
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    pyramid = load_lod_pyramid(dataset)
+    selected = pyramid.select(level, *(viewport or ()))
+    level = min(max(level, 0), len(pyramid.levels) - 1)
+    columns = [column for column in columns if column in table]
+    resp = {'level': level, 'bin_size': pyramid.bin_size(level), 'count': pyramid.bins['count'][selected]}
+    if mode == 'aggregate':
+        resp['bin_x'] = pyramid.bins['bin_x'][selected]
+        resp['bin_y'] = pyramid.bins['bin_y'][selected]
+        resp['x'] = pyramid.bins['mean_x'][selected]
+        resp['y'] = pyramid.bins['mean_y'][selected]
+        phenotype = pyramid.bins['phenotype'][selected]
+        names = np.array(pyramid.phenotypes + [''], dtype=object)
+        resp['phenotype'] = names[phenotype].tolist()
+        for column in columns:
+            resp[column] = pyramid.means(selected, table.column(column))
+    else:
+        rows = pyramid.bins['sample'][selected]
+        cells = table.rows(rows, ['id'] + columns)
+        for column in cells.columns:
+            resp[column] = _column_values(cells[column])
+    return resp
 
 
 def get_color_scheme(datasource_name, refresh, label_field='celltype'):
-
     # old os.path way:
     # color_scheme_path = str(
     #     Path(os.path.join(os.getcwd())) / data_path / datasource_name / str(
@@ -331,9 +458,13 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
     color_scheme_path = str(PurePath(cwd_path, data_path, datasource_name, str(
             label_field + "_color_scheme.pickle")) )
 
+    # Rebuilt when the phenotypes in the table may have changed
+    dataset = load_datasource(datasource_name, phase='table')
+    inputs = table_fingerprint(dataset, [get_phenotype_column_name(datasource_name) or 'celltype'],
+                               label_field=label_field)
     if refresh == False:
         #old os.path way:  if os.path.isfile(color_scheme_path):
-        if Path(color_scheme_path).is_file():
+        if Path(color_scheme_path).is_file() and fingerprint.is_current(color_scheme_path, inputs):
             print("Color Scheme Exists, Loading")
             color_scheme = pickle.load(open(color_scheme_path, "rb"))
             return color_scheme
@@ -377,152 +508,323 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
         color_scheme[str(labels[i])]['rgb'] = list(ImageColor.getcolor(colors[i], "RGB"))
         color_scheme[str(labels[i])]['hex'] = colors[i]
 
-    pickle.dump(color_scheme, open(color_scheme_path, 'wb'))
+    with open(color_scheme_path, 'wb') as f:
+        pickle.dump(color_scheme, f)
+    fingerprint.write(color_scheme_path, inputs)
     return color_scheme
 
 
-def get_rect_cells(datasource_name, rect, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-
-    # Query
-    index = ball_tree.query_radius([[rect[0], rect[1]]], r=rect[2])
-    print('Query size:', len(index[0]))
-    neighbors = index[0]
-    try:
-        neighborhood = []
-        for neighbor in neighbors:
-            row = datasource.iloc[[neighbor]]
-            obj = row.to_dict(orient='records')[0]
-            if 'celltype' not in obj:
-                obj['celltype'] = ''
-            neighborhood.append(obj)
-        return neighborhood
-    except:
-        return {}
-
-
-def get_gated_cells(datasource_name, gates, start_keys):
-    global datasource
-    global source
-    global ball_tree
+def get_rect_cells(datasource_name, rect, channels, format='records'):
+    """
+    Cells inside rect, either [x0, y0, x1, y1] or a circle [x, y, r], with the
+    given channels plus id (all columns if none are given). One dict per cell,
+    with celltype '' where the table has none (format='records'), or a dict of
+    whole columns (format='columns').
+    """
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    table = dataset.table
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-
-    query_string = ''
-    query_keys = start_keys
-    for key, value in gates.items():
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(value[0]) + ' < `' + key + '` < ' + str(value[1])
-        query_keys.append(key)
-    if query_string is None or query_string == "":
-        return []
-    # query_keys[0] is the ID]
-    query = datasource.query(query_string)[[query_keys[0]]].to_dict(orient='records')
-    return query
+    if len(rect) == 3:
+        rows = dataset.spatial_index.query_radius(rect[0], rect[1], rect[2])
+    else:
+        x0, y0, x1, y1 = rect
+        rows = dataset.spatial_index.query_rect(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+    if channels:
+        columns = ['id'] + [channel for channel in channels if channel in table and channel != 'id']
+    else:
+        columns = table.columns
+    cells = table.rows(rows, columns)
+    if format == 'columns':
+        return {column: _column_values(cells[column]) for column in columns}
+    records = cells.to_dict(orient='records')
+    if 'celltype' not in cells.columns:
+        for record in records:
+            record['celltype'] = ''
+    return records
+
+
+def _column_values(column):
+    # Numeric columns stay arrays (serialized without a copy), text becomes lists
+    values = column.to_numpy()
+    if values.dtype == object or isinstance(column.dtype, pd.CategoricalDtype):
+        return column.astype(object).where(column.notna(), None).tolist()
+    return values
+
+
+def get_channel_indexes(dataset, channels):
+    # Sorted indexes of those channels that have one, missing ones are built in the background
+    indexes = {}
+    if app.config['CHANNEL_INDEXES']:
+        for channel in channels:
+            index = load_channel_index(dataset, channel)
+            if index is not None:
+                indexes[channel] = index
+    return indexes
+
+
+def load_channel_index(dataset, channel):
+    with channel_index_lock:
+        if channel in dataset.channel_index_errors:
+            return None
+        if channel in dataset.channel_indexes:
+            return dataset.channel_indexes[channel]
+        table = dataset.table
+        if channel not in table.columns:
+            error = 'unknown channel'
+        elif not _is_numeric(table.column(channel)):
+            error = 'not numeric'
+        else:
+            error = None
+        if error is not None:
+            print('No sorted index of', channel + ':', error)
+            dataset.channel_index_errors[channel] = error
+            return None
+        dataset.channel_indexes[channel] = None
+    index_dir = Path(cwd_path, data_path, dataset.name, 'channel_index', channel_index.index_name(channel))
+    inputs = table_fingerprint(dataset, [channel], compact=app.config['COMPACT_CELL_TABLE'])
+    index = channel_index.load(index_dir) if fingerprint.is_current(index_dir, inputs) else None
+    if index is not None:
+        dataset.channel_indexes[channel] = index
+    else:
+        channel_index_builder.submit(build_channel_index, dataset, channel, index_dir, inputs)
+    return index
 
 
-def get_gated_cells_custom(datasource_name, gates, start_keys):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-
-    # Query
-    query_string = ''
-    query_keys = start_keys
-    for key, value in gates.items():
-        if query_string != '':
-            query_string += ' or '
-        query_string += str(value[0]) + ' < `' + key + '` < ' + str(value[1])
-        query_keys.append(key)
-    if query_string is None or query_string == "":
+def build_channel_index(dataset, channel, index_dir, inputs):
+    # Failures are recorded, the worker has no caller to raise them to
+    try:
+        index = channel_index.build(dataset.table.column(channel), index_dir)
+        fingerprint.write(index_dir, inputs)
+    except Exception as e:
+        print('Could not build the sorted index of', channel, e)
+        with channel_index_lock:
+            dataset.channel_index_errors[channel] = str(e)
+            dataset.channel_indexes.pop(channel, None)
+        return
+    dataset.channel_indexes[channel] = index
+
+
+def get_gated_rows(datasource_name, gates, combine='and', session=''):
+    # Rows of the cells in all (combine='and') or any ('or') of the gates, None without gates
+    dataset = load_datasource(datasource_name, phase='table')
+    indexes = get_channel_indexes(dataset, gates)
+    return gating.gates_rows(dataset.table, gates, combine, indexes, dataset.gate_masks, session)
+
+
+def get_gated_ids(datasource_name, gates, id_key='id', combine='and', encoding='ids', session=''):
+    # Binary payload of the cells in the gates, see gating.encode_rows
+    rows = get_gated_rows(datasource_name, gates, combine, session)
+    if rows is None:
+        return b''
+    table = load_datasource(datasource_name, phase='table').table
+    ids = table.rows(rows, [id_key])[id_key].to_numpy() if id_key != 'id' else None
+    return gating.encode_rows(rows, len(table), encoding, ids)
+
+
+def load_histograms(dataset):
+    # Cumulative histograms of the numeric columns, built along with the description
+    if dataset.histograms is not None:
+        return dataset.histograms
+    with histogram_lock:
+        if dataset.histograms is not None:
+            return dataset.histograms
+        table = dataset.table
+        columns = [column for column in table.columns if _is_numeric(table.column(column))]
+        histogram_path = Path(cwd_path, data_path, dataset.name, 'histograms.npz')
+        inputs = table_fingerprint(dataset, columns, bins=histograms.HISTOGRAM_BINS,
+                                   compact=app.config['COMPACT_CELL_TABLE'])
+        result = histograms.load(histogram_path) if fingerprint.is_current(histogram_path, inputs) else None
+        if result is None:
+            print("Creating cumulative histograms.")
+            result = histograms.build(((column, table.column(column)) for column in columns), len(table),
+                                      histogram_path)
+            fingerprint.write(histogram_path, inputs)
+            print("Creating cumulative histograms done.")
+        dataset.histograms = result
+    return result
+
+
+def _is_numeric(values):
+    return pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype)
+
+
+def get_gated_count(datasource_name, gates, combine='and', exact=False, session=''):
+    """
+    Number of cells in all (combine='and') or any ('or') of the gates, 0 without
+    gates. A single gate is counted exactly from its sorted index; until that is
+    built, and for several gates, the count is estimated from the cumulative
+    histograms unless exact.
+    """
+    if not gates:
+        return {'count': 0, 'exact': True}
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    indexes = get_channel_indexes(dataset, gates) if exact or len(gates) == 1 else {}
+    if not exact and not indexes:
+        hists = load_histograms(dataset)
+        if all(channel in hists for channel in gates):
+            return {'count': hists.estimate(gates, combine), 'exact': False}
+        indexes = get_channel_indexes(dataset, gates)
+    return {'count': gating.gates_count(table, gates, combine, indexes, dataset.gate_masks, session), 'exact': True}
+
+
+def get_gate_set_cells(datasource_name, gate_sets, combine='and', labels=False):
+    """
+    Cells of many named gate sets (e.g. one per phenotype) in one pass: for
+    each set its count and an encoded CellSet of its rows. With labels, also
+    the label of every row: the position of the first set (in the given order)
+    holding it, -1 for none, as base64 of int16 (int32 for 32768 sets or more).
+    """
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    masks = gating.gate_sets_masks(table, gate_sets, combine, dataset.gate_masks)
+    resp = {'sets': {}}
+    for name, mask in masks.items():
+        cells = CellSet.from_mask(mask) if mask is not None else CellSet()
+        resp['sets'][name] = {'count': len(cells), 'cells': cells.to_base64()}
+    if labels:
+        label_array = gating.exclusive_labels(list(masks.values()), len(table))
+        resp['labels'] = {'names': list(masks), 'dtype': label_array.dtype.name,
+                          'values': base64.b64encode(label_array.tobytes()).decode('ascii')}
+    return resp
+
+
+def get_gating_tree_counts(datasource_name, nodes, encoding=None):
+    """
+    Number of cells of every population of a gating tree (see gating.tree_order)
+    and of its parent population, by node id. With encoding='cellset' each node
+    also holds its cells as an encoded CellSet of rows. Populations are cached,
+    so after an edit only the edited node's subtree is evaluated.
+    """
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
+    masks = gating.tree_masks(table, nodes, dataset.gate_masks)
+    counts = {node_id: int(np.count_nonzero(mask)) for node_id, mask in masks.items()}
+    resp = {'total': len(table), 'nodes': {}}
+    for node in nodes:
+        parent = node.get('parent')
+        entry = {'count': counts[node['id']], 'parent_count': counts[parent] if parent is not None else len(table)}
+        if encoding == 'cellset':
+            entry['cells'] = CellSet.from_mask(masks[node['id']]).to_base64()
+        resp['nodes'][node['id']] = entry
+    return resp
+
+
+def save_gating_tree(datasource_name, name, nodes):
+    gating.tree_order(nodes)
+    database_model.save_list(database_model.GatingTree, datasource=datasource_name, name=name,
+                             cells=json.dumps(nodes).encode('utf-8'))
+
+
+def get_saved_gating_tree(datasource_name, name):
+    tree = database_model.get(database_model.GatingTree, datasource=datasource_name, name=name)
+    if tree is None:
+        return None
+    return json.loads(tree.cells.decode('utf-8'))
+
+
+def get_gated_cells(datasource_name, gates, start_keys, session=''):
+    # start_keys[0] is the ID
+    rows = get_gated_rows(datasource_name, gates, session=session)
+    if rows is None:
         return []
-    query = datasource.query(query_string)[query_keys].to_dict(orient='records')
-
-    # TODO - likely lighter / less costly
-    # query = database.query(query_string)[query_keys].to_dict('split')
-    # del query['index']
-
-    return query
+    table = load_datasource(datasource_name, phase='table').table
+    key = start_keys[0]
+    values = rows if key == 'id' else table.rows(rows, [key])[key].to_numpy()
+    return [{key: value} for value in values.tolist()]
+
+
+def get_gated_cells_custom(datasource_name, gates, start_keys, session='', format='records'):
+    """
+    The start_keys and gated columns of the cells in any of the gates. As one
+    dict per cell (format='records'), one array per column (format='columns')
+    or those arrays packed as binary (format='binary', see _pack_columns).
+    """
+    rows = get_gated_rows(datasource_name, gates, combine='or', session=session)
+    if rows is None:
+        rows = np.empty(0, dtype=np.intp)
+        if format == 'records':
+            return []
+    table = load_datasource(datasource_name, phase='table').table
+    query_keys = list(dict.fromkeys(start_keys + list(gates)))
+    cells = table.rows(rows, query_keys)
+    if format == 'binary':
+        return _pack_columns(cells)
+    if format == 'columns':
+        return {'count': len(rows), 'columns': {key: _column_values(cells[key]) for key in query_keys}}
+    return cells.to_dict(orient='records')
+
+
+def _pack_columns(frame):
+    """
+    Numeric columns of frame as one binary payload: a uint32 header length, a
+    JSON header {count, columns: [{name, dtype, offset}]} padded with spaces,
+    then every column's little-endian values at its offset from the end of the
+    header. Columns start at multiples of 8 bytes, so typed arrays can view them
+    without a copy. Raises ValueError for text columns.
+    """
+    columns, parts, offset = [], [], 0
+    for column in frame.columns:
+        values = frame[column].to_numpy()
+        if values.dtype == bool:
+            values = values.astype(np.uint8)
+        if not np.issubdtype(values.dtype, np.number):
+            raise ValueError('Column ' + str(column) + ' is not numeric')
+        values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        columns.append({'name': str(column), 'dtype': values.dtype.name, 'offset': offset})
+        parts += [values.tobytes(), bytes(-values.nbytes % 8)]
+        offset += values.nbytes + (-values.nbytes % 8)
+    header = json.dumps({'count': len(frame), 'columns': columns}).encode('utf-8')
+    header += b' ' * (-(4 + len(header)) % 8)
+    return b''.join([np.uint32(len(header)).astype('<u4').tobytes(), header] + parts)
 
 
 def get_all_cells(datasource_name, start_keys, data_type=float):
-    global datasource
-    global source
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-
-    query = datasource[start_keys].values.flatten('C');
+    query = table.frame(start_keys).values.flatten('C');
     if np.issubdtype(data_type, int):
         return query.astype(np.uint32)
     return query.astype(np.float32)
 
 
 def download_gating_csv(datasource_name, gates, channels, selection_ids, encoding):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-
-    csv = datasource.copy()
-    datasource_filter = datasource.copy()
+    # Returns the table as CSV text in chunks of rows, so the whole table is never held in memory at once
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
-    columns = []
-    if 'idField' in config[datasource_name]['featureData'][0]:
-        idField = config[datasource_name]['featureData'][0]['idField']
-    else:
-        idField = "CellID"
-    columns.append(idField)
+    idField = get_id_field(datasource_name)
 
+    in_gates = gating.gates_mask(table, gates, cache=dataset.gate_masks)
+    if in_gates is None:
+        in_gates = np.ones(len(table), dtype=bool)
     if selection_ids:
-        datasource_filter = datasource_filter[datasource_filter[idField].isin(selection_ids)]
-
-    query_string = ''
-    for key, value in gates.items():
-        columns.append(key)
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(value[0]) + ' < `' + key + '` < ' + str(value[1])
-    ids = datasource_filter.query(query_string)[['id']].to_numpy().flatten()
+        in_gates = in_gates & get_cell_set(dataset, selection_ids, idField).to_mask(len(table))
 
     if 'Area' in channels:
         del channels['Area']
-    for channel in channels:
-        if channel in gates:
-            if encoding == 'binary':
-                csv.loc[csv.index.isin(ids), channel] = 1
-            csv.loc[~csv.index.isin(ids), channel] = 0
-        else:
-            csv[channel] = 0
 
-    return csv
+    def csv_chunks():
+        chunk_rows = app.config['CSV_CHUNK_ROWS']
+        for start in range(0, max(len(table), 1), chunk_rows):
+            rows = np.arange(start, min(start + chunk_rows, len(table)))
+            csv = table.rows(rows)
+            csv_in_gates = in_gates[rows]
+            for channel in channels:
+                if channel in gates:
+                    if encoding == 'binary':
+                        csv.loc[csv_in_gates, channel] = 1
+                    csv.loc[~csv_in_gates, channel] = 0
+                else:
+                    csv[channel] = 0
+            yield csv.to_csv(index=False, header=start == 0)
 
+    return csv_chunks()
 
-def download_gates(datasource_name, gates, channels, lassos):
-    global datasource
-    global source
-    global ball_tree
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+def download_gates(datasource_name, gates, channels, lassos):
+    load_datasource(datasource_name, phase='config')
     arr = []
     for key, value in channels.items():
         arr.append([key, value[0], value[1]])
@@ -544,13 +846,7 @@ def download_gates(datasource_name, gates, channels, lassos):
 
 
 def save_gating_list(datasource_name, gates, channels, lassos):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name, phase='config')
     arr = []
     for key, value in channels.items():
         arr.append([key, value[0], value[1]])
@@ -579,13 +875,7 @@ def get_saved_gating_list(datasource_name):
 
 
 def download_channels(datasource_name, map_channels, active_channels, list_colors, list_ranges, list_channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name, phase='config')
     arr = []
     for channel in map_channels:
         channel_name = map_channels[channel]
@@ -605,13 +895,7 @@ def download_channels(datasource_name, map_channels, active_channels, list_color
 
 
 def save_channel_list(datasource_name, map_channels, active_channels, list_colors, list_ranges, list_channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name, phase='config')
     arr = []
     for channel in map_channels:
         channel_name = map_channels[channel]
@@ -638,17 +922,29 @@ def get_saved_channel_list(datasource_name):
 
 
 def get_datasource_description(datasource_name):
-    global datasource
-    global source
-    global ball_tree
     global config
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    description = datasource.describe().to_dict()
-    for column in description:
-        column_data = datasource[column].to_numpy()
+    dataset = load_datasource(datasource_name, phase='overview')
+    table = dataset.table
+    # For gate counts, see get_gated_count
+    load_histograms(dataset)
+
+    # Reused until the table, the image or the channels configured for it change
+    description_path = Path(cwd_path, data_path, datasource_name, 'description.pickle')
+    inputs = table_fingerprint(dataset, table.columns, files=[config[datasource_name]['channelFile']],
+                               image_channels=[channel['fullname'] for channel in config[datasource_name]['imageData']],
+                               compact=app.config['COMPACT_CELL_TABLE'])
+    if fingerprint.is_current(description_path, inputs):
+        with open(description_path, 'rb') as f:
+            return pickle.load(f)
+
+    # Summarised one column at a time so only one column needs to be resident
+    description = {}
+    for column in table.columns:
+        column_data = table.column(column)
+        if not _is_numeric(column_data):
+            continue
+        description[column] = pd.Series(column_data, copy=False).describe().to_dict()
         [hist, bin_edges] = np.histogram(column_data[~np.isnan(column_data)], bins=50, density=True)
         midpoints = (bin_edges[1:] + bin_edges[:-1]) / 2
         description[column]['histogram'] = {}
@@ -666,7 +962,7 @@ def get_datasource_description(datasource_name):
         if channel['name'] != 'Area':
             fullName = channel['fullname']
 
-            image_data = zarray[image_layer]
+            image_data = dataset.zarray[image_layer]
             img_log = np.log(image_data[image_data > 0])
             [hist, bin_edges] = np.histogram(img_log.flatten(), bins=50, density=True)
             midpoints = (bin_edges[1:] + bin_edges[:-1]) / 2
@@ -687,24 +983,27 @@ def get_datasource_description(datasource_name):
         else:
             continue
 
+    with open(description_path, 'wb') as f:
+        pickle.dump(description, f)
+    fingerprint.write(description_path, inputs)
     return description
 
 
 def get_channel_gmm(channel_name, datasource_name):
-    global datasource
-    global source
-    global ball_tree
     global config
+    with import_lock:
+        init_sklearn()
+        from sklearn.mixture import GaussianMixture
+        from scipy.stats import norm
 
     packet_gmm = {}
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    dataset = load_datasource(datasource_name, phase='overview')
+    table = dataset.table
 
     image_channelIdx = next(
         index for (index, d) in enumerate(config[datasource_name]['imageData']) if d["fullname"] == channel_name) - 1
-    image_data = zarray[image_channelIdx]
+    image_data = dataset.zarray[image_channelIdx]
     img_log = np.log(image_data[image_data > 0])
     gmm = GaussianMixture(3, max_iter=1000, tol=1e-6)
     gmm.fit(img_log.reshape((-1, 1)))
@@ -764,31 +1063,26 @@ def get_channel_gmm(channel_name, datasource_name):
 
 
 def get_gating_gmm(channel_name, datasource_name, selection_ids):
-    global datasource
-    global source
-    global ball_tree
     global config
+    with import_lock:
+        init_sklearn()
+        from sklearn.mixture import GaussianMixture
+        from scipy.stats import norm
 
     packet_gmm = {}
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    description = datasource.describe().to_dict()
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
-    datasource_filter = datasource.copy()
-    if 'idField' in config[datasource_name]['featureData'][0]:
-        idField = config[datasource_name]['featureData'][0]['idField']
-    else:
-        idField = "CellID"
-    if selection_ids:
-        datasource_filter = datasource_filter[datasource_filter[idField].isin(selection_ids)]
+    idField = get_id_field(datasource_name)
 
-    column_data = datasource[channel_name].to_numpy()
+    column_data = table.column(channel_name)
     [hist, bin_edges] = np.histogram(column_data[~np.isnan(column_data)], bins=50, density=True)
     midpoints = (bin_edges[1:] + bin_edges[:-1]) / 2
 
-    column_data_filtered = datasource_filter[channel_name].to_numpy()
+    column_data_filtered = column_data
+    if selection_ids:
+        column_data_filtered = column_data[get_cell_set(dataset, selection_ids, idField).to_rows()]
     gmm = GaussianMixture(n_components=2)
     gmm.fit(column_data_filtered.reshape((-1, 1)))
     i0, i1 = np.argsort(gmm.means_[:, 0])
@@ -817,30 +1111,25 @@ def get_gating_gmm(channel_name, datasource_name, selection_ids):
 
 
 def generate_zarr_png(datasource_name, channel, level, tile):
-    if config is None:
-        load_datasource(datasource_name)
-    global channels
-    global seg
-    [tx, ty] = tile.replace('.png', '').split('_')
-    tx = int(tx)
-    ty = int(ty)
-    level = int(level)
-    tile_width = config[datasource_name]['tileWidth']
-    tile_height = config[datasource_name]['tileHeight']
-    ix = tx * tile_width
-    iy = ty * tile_height
+    # Already imported while the channels were loaded
+    import zarr
+
+    dataset = load_datasource(datasource_name, phase='channels')
+    channels = dataset.channels
     segmentation = False
     try:
         channel_num = int(re.match(r".*_(\d*)$", channel).groups()[0])
     except AttributeError:
         segmentation = True
     if segmentation:
-        tile = seg[level][iy:iy + tile_height, ix:ix + tile_width]
+        tile = read_segmentation_tile(dataset, level, tile)
         if tile.dtype.itemsize != 4:
             tile = tile.astype(np.uint32)
         tile = tile.view('uint8').reshape(tile.shape + (-1,))[..., [0, 1, 2]]
         tile = np.append(tile, np.zeros((tile.shape[0], tile.shape[1], 1), dtype='uint8'), axis=2)
     else:
+        ix, iy, tile_width, tile_height = _tile_region(datasource_name, tile)
+        level = int(level)
         if isinstance(channels, zarr.Array):
             tile = channels[channel_num, iy:iy + tile_height, ix:ix + tile_width]
         else:
@@ -852,14 +1141,122 @@ def generate_zarr_png(datasource_name, channel, level, tile):
     return tile
 
 
+def get_tile(datasource_name, channel, level, tile):
+    """
+    Encoded PNG of a channel or segmentation tile (see generate_zarr_png) and
+    its strong ETag, a digest of the PNG. Kept in the dataset's tile cache, so
+    repeated requests neither read the image nor encode it again.
+    """
+    dataset = load_datasource(datasource_name, phase='channels')
+    key = (channel, int(level), tile, PurePath(tile).suffix.lower() or '.png')
+    entry = dataset.tiles.get(key)
+    if entry is None:
+        file_object = io.BytesIO()
+        Image.fromarray(generate_zarr_png(datasource_name, channel, level, tile)).save(file_object, 'PNG',
+                                                                                      compress_level=0)
+        png = file_object.getvalue()
+        entry = dataset.tiles.put(key, (png, _etag(png)), len(png))
+    return entry
+
+
+def _etag(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _tile_region(datasource_name, tile):
+    # Pixel origin and size of a tile named like 16_18.png
+    [tx, ty] = tile.replace('.png', '').split('_')
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    return int(tx) * tile_width, int(ty) * tile_height, tile_width, tile_height
+
+
+def read_segmentation_tile(dataset, level, tile):
+    # Labels of the segmentation mask in a tile of a pyramid level
+    ix, iy, tile_width, tile_height = _tile_region(dataset.name, tile)
+    return dataset.seg[int(level)][iy:iy + tile_height, ix:ix + tile_width]
+
+
+def get_overlay_tile(datasource_name, level, tile, cell_set=None, gates=None, combine='and', color='#ffff00',
+                     alpha=255):
+    """
+    PNG of a segmentation tile with the cells of a saved cell set (by name) or
+    of the gates filled in color, everything else transparent, ready to blend
+    over the image. Mask labels are looked up in a table of the set's members
+    by ID. Rendered tiles are cached per version of the set, so tiles of a set
+    saved again or of other gates are rendered anew. Returns the PNG and its
+    ETag, None for unknown sets.
+    """
+    dataset = load_datasource(datasource_name, phase='channels')
+    if cell_set is not None:
+        version = get_cell_set_version(dataset, cell_set)
+        if version is None:
+            return None
+    else:
+        version = ('gates', combine, frozenset((channel, float(lo), float(hi)) for channel, (lo, hi) in gates.items()))
+    rgba = ImageColor.getrgb(color)[:3] + (int(alpha),)
+    key = ('tile', version, int(level), tile, rgba)
+    entry = dataset.overlays.get(key)
+    if entry is None:
+        lut = get_membership_lut(dataset, version, cell_set, gates, combine)
+        labels = np.asarray(read_segmentation_tile(dataset, level, tile)).astype(np.int64, copy=False)
+        inside = lut[np.clip(labels, 0, len(lut) - 1)] & (labels < len(lut))
+        pixels = np.zeros(labels.shape + (4,), dtype=np.uint8)
+        pixels[inside] = rgba
+        file_object = io.BytesIO()
+        Image.fromarray(pixels, 'RGBA').save(file_object, 'PNG', compress_level=1)
+        png = file_object.getvalue()
+        entry = dataset.overlays.put(key, (png, _etag(png)), len(png))
+    return entry
+
+
+def get_cell_set_version(dataset, name):
+    # Digest of a saved cell set, None if there is none by that name
+    version = dataset.cell_set_versions.get(name)
+    if version is None:
+        selection = database_model.get(database_model.CellSelection, datasource=dataset.name, name=name)
+        if selection is None:
+            return None
+        version = ('cellset', name, hashlib.blake2b(selection.cells, digest_size=8).hexdigest())
+        dataset.cell_set_versions[name] = version
+    return version
+
+
+def get_membership_lut(dataset, version, cell_set=None, gates=None, combine='and'):
+    # Boolean lookup table by mask label (cell ID): whether the cell is in the set, background (0) never is
+    key = ('lut', version)
+    lut = dataset.overlays.get(key)
+    if lut is None:
+        table = dataset.table
+        if cell_set is not None:
+            selection = database_model.get(database_model.CellSelection, datasource=dataset.name, name=cell_set)
+            rows = CellSet.from_bytes(selection.cells).to_rows()
+        else:
+            # Under a session of its own, so tiles don't reset the incremental gating of the client's gates
+            rows = gating.gates_rows(table, gates, combine, get_channel_indexes(dataset, gates), dataset.gate_masks,
+                                     session='overlay')
+            if rows is None:
+                rows = np.arange(len(table))
+        id_field = get_id_field(dataset.name)
+        ids = np.asarray(table.rows(rows, [id_field])[id_field].to_numpy(), dtype=np.int64)
+        ids = ids[ids >= 0]
+        lut = np.zeros(int(ids.max()) + 1 if len(ids) > 0 else 1, dtype=bool)
+        lut[ids] = True
+        lut[0] = False
+        dataset.overlays.put(key, lut, lut.nbytes)
+    return lut
+
+
 def get_ome_metadata(datasource_name):
-    if config is None:
-        load_datasource(datasource_name)
-    global metadata
-    return metadata
+    return load_datasource(datasource_name, phase='channels').metadata
 
 
 def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelImg=False):
+    with import_lock:
+        import tifffile as tf
+        import zarr
+        from minerva_analysis.server.utils import pyramid_assemble, pyramid_upgrade
+
     channel_info = {}
     channelNames = []
 
@@ -908,57 +1305,117 @@ def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelIm
 
 
 def logTransform(csvPath, skip_columns=[]):
-    df = pd.read_csv(csvPath)
-    for column in df.columns:
-        if column not in skip_columns:
-            df[column] = np.log1p(df[column])
-    df.to_csv(csvPath, index=False)
+    # A chunk of rows at a time, written to a new file that then replaces the original
+    tmp_path = str(csvPath) + '.tmp'
+    first_chunk = True
+    for df in pd.read_csv(csvPath, chunksize=app.config['CSV_CHUNK_ROWS']):
+        for column in df.columns:
+            if column not in skip_columns:
+                df[column] = np.log1p(df[column])
+        df.to_csv(tmp_path, index=False, header=first_chunk, mode='w' if first_chunk else 'a')
+        first_chunk = False
+    if not first_chunk:
+        os.replace(tmp_path, csvPath)
 
 # similar_neighborhood=False, embedding=False
-def get_cells_in_polygon(datasource_name, points):
+def get_cells_in_polygon(datasource_name, points, encoding='ids'):
     global config
-    global datasource
-    global ball_tree
+    with import_lock:
+        import matplotlib.path as mpltPath
 
-    if datasource_name != source:
-        load_datasource(datasource_name)
+    dataset = load_datasource(datasource_name, phase='spatial_index')
+    table = dataset.table
 
     point_tuples = [(e['imagePoints']['x'], e['imagePoints']['y']) for e in points]
     (x, y, r) = smallestenclosingcircle.make_circle(point_tuples)
 
-    index = ball_tree.query_radius([[x, y]], r)
-    neighbors = index[0]
-    circle_neighbors = datasource.iloc[neighbors].to_dict(orient='records')
-    neighbor_points = pd.DataFrame(circle_neighbors).values
+    neighbors = dataset.spatial_index.query_radius(x, y, r)
+    feature_data = config[datasource_name]['featureData'][0]
+    neighbor_points = table.rows(neighbors, [get_id_field(datasource_name), feature_data['xCoordinate'],
+                                             feature_data['yCoordinate']]).values
 
     path = mpltPath.Path(point_tuples)
     inside = path.contains_points(neighbor_points[:, [1, 2]].astype('float'))
+    if encoding == 'cellset':
+        return CellSet.from_rows(neighbors[inside]).to_base64()
     neighbor_ids = neighbor_points[np.where(inside == True), 0].astype('int').flatten().tolist()
     neighbor_ids.sort()
 
     packet = neighbor_ids
     return packet
 
-def get_cells_in_lassos(datasource_name, list_lassos):
-    global config
-    global datasource
-    global ball_tree
-
-    if datasource_name != source:
-        load_datasource(datasource_name)
+def get_cells_in_lassos(datasource_name, list_lassos, encoding='ids'):
+    # Lasso IDs are lists of cell IDs or encoded CellSets of rows
+    dataset = load_datasource(datasource_name, phase='table')
+    table = dataset.table
 
+    id_field = get_id_field(datasource_name)
     list_lassos_active = {k: v for k, v in list_lassos.items() if v.get('lasso_toggle') == True}
 
-    list_ids = []
-    list_ids_subtract = []
+    cells = CellSet()
     for v in list_lassos_active.values():
-        list_ids.extend(v.get('lasso_ids', []))
-        list_ids_subtract.extend(v.get('lasso_ids_subtract', []))
-    list_ids = list(set(list_ids))
-    list_ids.sort()
+        cells = cells | get_cell_set(dataset, v.get('lasso_ids', []), id_field)
+    cells_subtract = cells.complement(len(table))
 
-    list_ids_subtract = list(set(datasource['CellID']) - set(list_ids))
-    list_ids_subtract.sort()
-
-    packet = {'lasso_ids': list_ids, 'lasso_ids_subtract': list_ids_subtract}
+    if encoding == 'cellset':
+        return {'lasso_ids': cells.to_base64(), 'lasso_ids_subtract': cells_subtract.to_base64()}
+    packet = {'lasso_ids': get_cell_ids(dataset, cells, id_field).tolist(),
+              'lasso_ids_subtract': get_cell_ids(dataset, cells_subtract, id_field).tolist()}
     return packet
+
+
+def get_cell_set(dataset, cells, id_field):
+    # CellSet of the rows of cells, a list of IDs (values of id_field) or an encoded CellSet of rows
+    if isinstance(cells, str):
+        return CellSet.from_base64(cells)
+    return CellSet.from_rows(get_id_rows(dataset, id_field, cells))
+
+
+def get_cell_ids(dataset, cells, id_field):
+    # IDs of the cells in the CellSet cells, in increasing order
+    rows = cells.to_rows()
+    if id_field == 'id':
+        return rows
+    return np.sort(dataset.table.rows(rows, [id_field])[id_field].to_numpy())
+
+
+def get_id_rows(dataset, id_field, ids):
+    # Rows of the cells with the given IDs, unknown IDs are left out
+    index = dataset.id_indexes.get(id_field)
+    if index is None:
+        values = np.asarray(dataset.table.column(id_field))
+        if np.all(values[1:] >= values[:-1]):
+            index = channel_index.SortedIndex(values, np.arange(len(values)))
+        else:
+            order = np.argsort(values, kind='stable')
+            index = channel_index.SortedIndex(values[order], order)
+        dataset.id_indexes[id_field] = index
+    return index.find(ids)
+
+
+def save_cell_set(datasource_name, name, cells):
+    # Stores a selection (IDs or an encoded CellSet) under name
+    dataset = load_datasource(datasource_name, phase='table')
+    cell_set = get_cell_set(dataset, cells, get_id_field(datasource_name))
+    database_model.save_list(database_model.CellSelection, datasource=datasource_name, name=name,
+                             cells=cell_set.to_bytes())
+    # Overlays of the set are rendered anew
+    dataset.cell_set_versions.pop(name, None)
+    return len(cell_set)
+
+
+def get_saved_cell_set(datasource_name, name, encoding='ids'):
+    selection = database_model.get(database_model.CellSelection, datasource=datasource_name, name=name)
+    if selection is None:
+        return None
+    cell_set = CellSet.from_bytes(selection.cells)
+    if encoding == 'cellset':
+        return cell_set.to_base64()
+    dataset = load_datasource(datasource_name, phase='table')
+    return get_cell_ids(dataset, cell_set, get_id_field(datasource_name)).tolist()
+
+
+def get_id_field(datasource_name):
+    if 'idField' in config[datasource_name]['featureData'][0]:
+        return config[datasource_name]['featureData'][0]['idField']
+    return "CellID"
@@ -3,11 +3,26 @@ from sqlalchemy.orm import relationship
 from sqlalchemy import func
 
 import io
+import threading
 import numpy as np
 
+_tables_lock = threading.Lock()
+_tables_created = False
+
+
+def create_tables():
+    # The tables are created on first use rather than when the server starts
+    global _tables_created
+    with _tables_lock:
+        if not _tables_created:
+            with app.app_context():
+                db.create_all()
+            _tables_created = True
+
 
 # Via https://stackoverflow.com/questions/2546207/does-sqlalchemy-have-an-equivalent-of-djangos-get-or-create
 def create(model, **kwargs):
+    create_tables()
     instance = model(**kwargs)
     db.session.add(instance)
     db.session.commit()
@@ -15,20 +30,24 @@ def create(model, **kwargs):
 
 
 def get(model, **kwargs):
+    create_tables()
     return db.session.query(model).filter_by(**kwargs).one_or_none()
 
 
 def edit(model, id, edit_field, edit_value):
+    create_tables()
     instance = get(model, id=id)
     instance.__setattr__(edit_field, edit_value)
     db.session.commit()
 
 
 def get_all(model, **kwargs):
+    create_tables()
     return db.session.query(model).filter_by(is_deleted=False, **kwargs).order_by(model.id).all()
 
 
 def get_or_create(model, **kwargs):
+    create_tables()
     if 'cells' in kwargs:
         cells = kwargs['cells']
         del kwargs['cells']
@@ -43,6 +62,7 @@ def get_or_create(model, **kwargs):
 
 
 def save_list(model, **kwargs):
+    create_tables()
     if 'cells' in kwargs:
         cells = kwargs['cells']
         del kwargs['cells']
@@ -75,5 +95,21 @@ class GatingList(db.Model):
     is_deleted = db.Column(db.Boolean, default=False, nullable=False)
 
 
-with app.app_context():
-    db.create_all()
+class CellSelection(db.Model):
+    __tablename__ = 'cellselection'
+    id = db.Column(db.Integer, primary_key=True)
+    datasource = db.Column(db.String(80), unique=False, nullable=False)
+    name = db.Column(db.String(80), unique=False, nullable=False)
+    # An encoded CellSet of rows
+    cells = db.Column(db.LargeBinary, nullable=False)
+    is_deleted = db.Column(db.Boolean, default=False, nullable=False)
+
+
+class GatingTree(db.Model):
+    __tablename__ = 'gatingtree'
+    id = db.Column(db.Integer, primary_key=True)
+    datasource = db.Column(db.String(80), unique=False, nullable=False)
+    name = db.Column(db.String(80), unique=False, nullable=False)
+    # The nodes of the tree as JSON, see gating.tree_order
+    cells = db.Column(db.LargeBinary, nullable=False)
+    is_deleted = db.Column(db.Boolean, default=False, nullable=False)
@@ -0,0 +1,221 @@
+# Registry of the datasets currently loaded in the server process.
+#
+# Each dataset holds its own cell table, spatial index and image handles, so
+# several slides can be served at once. Datasets are evicted least recently
+# used first once their combined resident size exceeds the memory budget.
+#
+# Datasets load in the background, one phase after the other. A request only
+# waits for the phase it needs, and requests arriving during a load wait on
+# that load instead of starting another one. When a phase fails, the phases
+# before it stay available and only the failed ones are loaded again, once a
+# request needs them.
+from contextlib import contextmanager
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from minerva_analysis.server.utils.lru_cache import LRUCache
+
+# Bytes of summed-area tables kept per dataset
+DENSITY_CACHE_BYTES = 256 * 1024 ** 2
+# Bytes of gate masks kept per dataset
+GATE_MASK_CACHE_BYTES = 512 * 1024 ** 2
+# Bytes of membership lookup tables and rendered overlay tiles kept per dataset
+OVERLAY_CACHE_BYTES = 128 * 1024 ** 2
+# Bytes of encoded image tiles kept per dataset
+TILE_CACHE_BYTES = 256 * 1024 ** 2
+# Loading phases in order, with their share of the progress reported for a load
+PHASES = [('config', 0), ('table', 60), ('spatial_index', 25), ('segmentation', 5), ('channels', 5),
+          ('overview', 5)]
+
+
+class LoadedDataset:
+    def __init__(self, name):
+        self.name = name
+        self.table = None
+        self.spatial_index = None
+        # Summed-area tables of the cells, None for all, or by the cells they count
+        self.densities = LRUCache(DENSITY_CACHE_BYTES)
+        # Masks of gates and of their combinations, see gating.gates_mask
+        self.gate_masks = LRUCache(GATE_MASK_CACHE_BYTES)
+        # Label lookup tables and encoded overlay tiles of cell sets, see data_model.get_overlay_tile
+        self.overlays = LRUCache(OVERLAY_CACHE_BYTES)
+        # Encoded image tiles with their ETags, see data_model.get_tile
+        self.tiles = LRUCache(TILE_CACHE_BYTES)
+        # Versions (content digests) of the saved cell sets by name
+        self.cell_set_versions = {}
+        self.lod_pyramid = None
+        # Cumulative histograms of the numeric columns, see histograms.CumulativeHistograms
+        self.histograms = None
+        # Sorted indexes by channel, None while one is built
+        self.channel_indexes = {}
+        # Why channels have no sorted index (unknown, not numeric, failed to build), these are not tried again
+        self.channel_index_errors = {}
+        # In-memory sorted indexes of ID columns, to find the rows of cells by ID
+        self.id_indexes = {}
+        self.seg = None
+        self.channels = None
+        self.zarray = None
+        self.metadata = None
+        self.loaded_at = time.time()
+        self.nbytes = 0
+        self.phase = None
+        # Fraction of the current phase done, for phases that report it
+        self.phase_progress = 0
+        self.timings = {}
+        self.error = None
+        self._ready = {phase: threading.Event() for phase, weight in PHASES}
+
+    @contextmanager
+    def loading_phase(self, phase):
+        self.phase = phase
+        self.phase_progress = 0
+        start = time.perf_counter()
+        yield
+        self.timings[phase] = time.perf_counter() - start
+        print("%s took %.2fs" % (phase.replace('_', ' ').capitalize(), self.timings[phase]))
+        self._ready[phase].set()
+
+    def report_progress(self, fraction):
+        self.phase_progress = fraction
+
+    def wait_for(self, phase):
+        self._ready[phase].wait()
+        if self.error is not None and phase not in self.timings:
+            raise RuntimeError('Loading ' + self.name + ' failed: ' + str(self.error)) from self.error
+        return self
+
+    def failed(self, error):
+        self.error = error
+        for event in self._ready.values():
+            event.set()
+
+    def resume(self):
+        # Clears the error of a failed load, so the phases it did not complete can be loaded again
+        self.error = None
+        for phase, event in self._ready.items():
+            if phase not in self.timings:
+                event.clear()
+
+    def needs(self, phase):
+        return phase not in self.timings
+
+    def is_loaded(self):
+        return all(phase in self.timings for phase, weight in PHASES)
+
+    def status(self):
+        percent = sum(weight for phase, weight in PHASES if phase in self.timings)
+        if self.phase is not None and self.phase not in self.timings:
+            percent += int(dict(PHASES)[self.phase] * self.phase_progress)
+        return {'datasource': self.name, 'phase': self.phase, 'percent': percent, 'loaded': self.is_loaded(),
+                'ready': [phase for phase, weight in PHASES if phase in self.timings],
+                'error': str(self.error) if self.error is not None else None}
+
+    def resident_size(self):
+        # Lazily read image pyramids (zarr over tiff) are not counted, only what
+        # is held in memory: resident table columns, the spatial index, centroid
+        # pyramid and histograms, density tables, gate masks, overlays, encoded
+        # tiles and in-memory arrays.
+        return sum(_nbytes(part) for part in
+                   [self.table, self.spatial_index, self.lod_pyramid, self.histograms, self.seg, self.channels,
+                    self.zarray]) + \
+            self.densities.total_bytes + self.gate_masks.total_bytes + self.overlays.total_bytes + \
+            self.tiles.total_bytes
+
+
+def _nbytes(obj):
+    if obj is None:
+        return 0
+    if hasattr(obj, 'resident_bytes'):
+        # ColumnStore, SpatialIndex, CentroidPyramid, CumulativeHistograms
+        return obj.resident_bytes()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return 0
+
+
+class DatasetRegistry:
+    def __init__(self, loader, memory_budget):
+        self._loader = loader
+        self._datasets = LRUCache(memory_budget, on_evict=self._evicted)
+        # Datasets still loading, kept out of the LRU so they cannot be evicted mid-load
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def start(self, name, reload=False, phase='overview'):
+        """
+        Returns the dataset registered under name, starting a background load
+        if there is none. A dataset whose load failed before phase resumes
+        loading from the phase that failed.
+        """
+        with self._lock:
+            dataset = None
+            if not reload:
+                dataset = self._loading.get(name)
+                if dataset is not None:
+                    return dataset
+                dataset = self._datasets.get(name)
+                if dataset is not None and (dataset.error is None or not dataset.needs(phase)):
+                    return dataset
+            self._datasets.pop(name)
+            if dataset is not None:
+                dataset.resume()
+            else:
+                dataset = LoadedDataset(name)
+            self._loading[name] = dataset
+        threading.Thread(target=self._load, args=(dataset, reload), name='load-' + name, daemon=True).start()
+        return dataset
+
+    def get(self, name, reload=False, phase='overview'):
+        dataset = self.start(name, reload=reload, phase=phase).wait_for(phase)
+        self._touch(dataset)
+        return dataset
+
+    def status(self, name):
+        with self._lock:
+            dataset = self._loading.get(name) or self._datasets.peek(name)
+        if dataset is None:
+            return {'datasource': name, 'phase': None, 'percent': 0, 'loaded': False, 'ready': [], 'error': None}
+        return dataset.status()
+
+    def discard(self, name):
+        with self._lock:
+            self._loading.pop(name, None)
+            self._datasets.pop(name)
+
+    def report(self):
+        with self._lock:
+            loading = list(self._loading)
+        return [{'datasource': name, 'resident_bytes': nbytes} for name, nbytes in self._datasets.sizes()] + \
+            [{'datasource': name, 'resident_bytes': 0, 'loading': True} for name in loading]
+
+    def _load(self, dataset, reload):
+        try:
+            self._loader(dataset, reload)
+        except Exception as e:
+            traceback.print_exc()
+            # The phases loaded stay available, see start
+            dataset.failed(e)
+        dataset.nbytes = dataset.resident_size()
+        if dataset.error is None:
+            print("Loaded", dataset.name, "(%.1f MB resident)" % (dataset.nbytes / 1024 ** 2))
+        with self._lock:
+            # Charged to the budget once loading stops, unless a reload has replaced it in the meantime
+            if self._loading.get(dataset.name) is dataset:
+                del self._loading[dataset.name]
+                self._datasets.put(dataset.name, dataset, dataset.nbytes)
+
+    def _touch(self, dataset):
+        # Table columns are read lazily, so a dataset's resident size grows as it is used
+        nbytes = dataset.resident_size()
+        if nbytes != dataset.nbytes:
+            dataset.nbytes = nbytes
+            with self._lock:
+                if self._datasets.peek(dataset.name) is dataset:
+                    self._datasets.put(dataset.name, dataset, nbytes)
+        return dataset
+
+    def _evicted(self, name, dataset):
+        print("Evicted", name, "(%.1f MB)" % (dataset.nbytes / 1024 ** 2), "to stay within the memory budget")
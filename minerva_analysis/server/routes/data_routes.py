@@ -7,6 +7,7 @@ from minerva_analysis.server.models import data_model
 from pathlib import Path
 from time import time
 import pandas as pd
+import numpy as np
 import gzip
 import json
 import orjson
@@ -18,11 +19,24 @@ from flask_sqlalchemy import SQLAlchemy
 @app.route('/init_database', methods=['GET'])
 def init_database():
     datasource = request.args.get('datasource')
-    data_model.init(datasource)
-    resp = jsonify(success=True)
+    status = data_model.init(datasource)
+    resp = jsonify(success=True, status=status)
     return resp
 
 
+@app.route('/get_load_status', methods=['GET'])
+def get_load_status():
+    datasource = request.args.get('datasource')
+    resp = data_model.get_load_status(datasource)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/get_loaded_datasources', methods=['GET'])
+def get_loaded_datasources():
+    resp = data_model.get_loaded_datasources()
+    return serialize_and_submit_json(resp)
+
+
 @app.route('/config')
 def serve_config():
     return get_config()
@@ -37,6 +51,59 @@ def get_nearest_cell():
     return serialize_and_submit_json(resp)
 
 
+# Nearest cells of many points in one request. Takes either a JSON body with the
+# datasource, points ([[x, y], ...]), k, columns, max_distance and format, or the
+# points as a binary body of float32 (or float64 with dtype=float64) x, y pairs
+# with the other parameters in the query string (columns comma separated, *
+# for all).
+# format=json returns rows, distances and the requested columns as flat arrays
+# of the m * k results (nearest first for each point, null where no cell was
+# found). format=binary returns them gzipped back to back: rows as int32 (-1 for
+# none), distances as float32 and the columns as float32.
+@app.route('/get_nearest_cells', methods=['POST'])
+def get_nearest_cells():
+    if request.mimetype == 'application/octet-stream':
+        params = request.args
+        dtype = np.float64 if params.get('dtype') == 'float64' else np.float32
+        points = np.frombuffer(request.get_data(), dtype=dtype).reshape(-1, 2)
+        columns = [column for column in params.get('columns', '').split(',') if column != '']
+    else:
+        params = request.get_json()
+        points = np.asarray(params['points'], dtype=np.float64).reshape(-1, 2)
+        columns = params.get('columns') or []
+    datasource = params.get('datasource')
+    k = max(int(params.get('k', 1)), 1)
+    max_distance = params.get('max_distance')
+    max_distance = float(max_distance) if max_distance is not None else None
+    resp = data_model.get_nearest_cells(datasource, points, k, columns, max_distance)
+    columns = resp['columns']
+
+    found = resp['found'].ravel()
+    if params.get('format', 'json') == 'binary':
+        parts = [resp['rows'].astype(np.int32), resp['distances'].astype(np.float32)]
+        for column in columns:
+            values = resp['values'][column]
+            if not np.issubdtype(values.dtype, np.number) and values.dtype != bool:
+                abort(400, 'Column ' + column + ' is not numeric')
+            column_values = np.full(len(found), np.nan, dtype=np.float32)
+            column_values[found] = values
+            parts.append(column_values)
+        return serialize_and_submit_binary(b''.join(part.tobytes('C') for part in parts))
+
+    values = {}
+    for column in columns:
+        if found.all():
+            values[column] = resp['values'][column]
+        else:
+            column_values = np.full(len(found), None, dtype=object)
+            column_values[found] = resp['values'][column]
+            values[column] = column_values.tolist()
+        if isinstance(values[column], np.ndarray) and values[column].dtype == object:
+            values[column] = values[column].tolist()
+    return serialize_and_submit_json({'k': k, 'count': len(points), 'rows': resp['rows'].ravel(),
+                                      'distances': resp['distances'].ravel(), 'columns': values})
+
+
 # Gets a row based on the index
 @app.route('/get_database_row', methods=['GET'])
 def get_database_row():
@@ -86,13 +153,51 @@ def get_naive_states():
     os.path.join(os.getcwd() / data_path / "data"  / "umicst-162-models.csv")
 
 
+# Counts come from summed-area tables: exact=false estimates them from the bin
+# counts alone, phenotype only counts the cells of that phenotype
 @app.route('/get_num_cells_in_circle', methods=['GET'])
 def get_num_cells_in_circle():
     datasource = request.args.get('datasource')
     x = float(request.args.get('point_x'))
     y = float(request.args.get('point_y'))
     r = float(request.args.get('radius'))
-    resp = data_model.get_number_of_cells_in_circle(x, y, datasource, r=r)
+    exact = request.args.get('exact', 'true') != 'false'
+    phenotype = request.args.get('phenotype')
+    resp = data_model.get_number_of_cells_in_circle(x, y, datasource, r=r, exact=exact, phenotype=phenotype)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/get_num_cells_in_rect', methods=['GET'])
+def get_num_cells_in_rect():
+    # rect - x0,y0,x1,y1
+    datasource = request.args.get('datasource')
+    rect = [float(x) for x in request.args.get('rect').split(',')]
+    if len(rect) != 4:
+        abort(400, 'rect must be x0,y0,x1,y1')
+    exact = request.args.get('exact', 'true') != 'false'
+    phenotype = request.args.get('phenotype')
+    resp = data_model.get_number_of_cells_in_rect(datasource, rect, exact=exact, phenotype=phenotype)
+    return serialize_and_submit_json(resp)
+
+
+# Zoomed-out views: one entry per bin of BIN_PIXELS screen pixels at the image
+# pyramid level, instead of every cell. mode=sample returns the cell closest to
+# each bin centre with the given columns, mode=aggregate the bins' counts, mean
+# centroids, most common phenotypes and the means of the given columns.
+@app.route('/get_lod_cells', methods=['GET'])
+def get_lod_cells():
+    datasource = request.args.get('datasource')
+    level = int(request.args.get('level', 0))
+    viewport = request.args.get('viewport')
+    if viewport:
+        viewport = [float(x) for x in viewport.split(',')]
+        if len(viewport) != 4:
+            abort(400, 'viewport must be x0,y0,x1,y1')
+    mode = request.args.get('mode', 'sample')
+    if mode not in ('sample', 'aggregate'):
+        abort(400, 'mode must be sample or aggregate')
+    columns = [column for column in request.args.get('columns', '').split(',') if column != '']
+    resp = data_model.get_lod_cells(datasource, level, viewport, mode, columns)
     return serialize_and_submit_json(resp)
 
 
@@ -102,12 +207,7 @@ def get_all_cells(dtype):
     data_type = int if 'integer' == dtype else float
     start_keys = list(request.args.get('start_keys').split(','))
     resp = data_model.get_all_cells(datasource, start_keys, data_type)
-    content = gzip.compress(resp.tobytes('C'))
-    response = make_response(content)
-    response.headers.set('Content-Type', 'application/octet-stream')
-    response.headers['Content-length'] = len(content)
-    response.headers['Content-Encoding'] = 'gzip'
-    return response
+    return serialize_and_submit_binary(resp.tobytes('C'))
 
 
 @app.route('/get_gated_cell_ids', methods=['GET'])
@@ -115,16 +215,80 @@ def get_gated_cell_ids():
     datasource = request.args.get('datasource')
     filter = json.loads(request.args.get('filter'))
     start_keys = list(request.args.get('start_keys').split(','))
-    resp = data_model.get_gated_cells(datasource, filter, start_keys)
+    # Identifies the client whose previous gates the cached gate masks are recombined from
+    session = request.args.get('session', '')
+    resp = data_model.get_gated_cells(datasource, filter, start_keys, session)
+    return serialize_and_submit_json(resp)
+
+
+# The cells in the gates as gzipped binary: encoding=ids packs their IDs (the
+# values of start_keys[0], row indices by default) as uint32, encoding=bitset
+# sets one bit per row, encoding=cellset encodes a CellSet of the rows.
+# combine=or keeps the cells in any gate instead of all.
+@app.route('/get_gated_cell_ids_binary', methods=['GET'])
+def get_gated_cell_ids_binary():
+    datasource = request.args.get('datasource')
+    filter = json.loads(request.args.get('filter'))
+    id_key = request.args.get('start_keys', 'id').split(',')[0]
+    combine = request.args.get('combine', 'and')
+    encoding = request.args.get('encoding', 'ids')
+    if combine not in ('and', 'or') or encoding not in ('ids', 'bitset', 'cellset'):
+        abort(400, 'combine must be and or or, encoding ids, bitset or cellset')
+    session = request.args.get('session', '')
+    resp = data_model.get_gated_ids(datasource, filter, id_key, combine, encoding, session)
+    return serialize_and_submit_binary(resp)
+
+
+# Number of cells in the gates, for feedback while a gate is adjusted. One gate
+# is counted exactly once its sorted index is built, until then and for several
+# gates the count is estimated from cumulative histograms unless exact=true.
+# The response says whether the count is exact.
+@app.route('/get_gated_cell_count', methods=['GET'])
+def get_gated_cell_count():
+    datasource = request.args.get('datasource')
+    filter = json.loads(request.args.get('filter', '{}'))
+    combine = request.args.get('combine', 'and')
+    if combine not in ('and', 'or'):
+        abort(400, 'combine must be and or or')
+    exact = request.args.get('exact', 'false') == 'true'
+    session = request.args.get('session', '')
+    resp = data_model.get_gated_count(datasource, filter, combine, exact, session)
     return serialize_and_submit_json(resp)
 
 
+# Many named gate sets in one request, e.g. one per phenotype: gate_sets is
+# {name: {channel: [lo, hi]}}. Returns each set's count and cells (an encoded
+# CellSet of rows), and with labels=true the mutually exclusive label of every
+# cell, the first set holding it in the given order.
+@app.route('/get_gated_cell_sets', methods=['POST'])
+def get_gated_cell_sets():
+    post_data = json.loads(request.data)
+    datasource = post_data['datasource']
+    combine = post_data.get('combine', 'and')
+    if combine not in ('and', 'or'):
+        abort(400, 'combine must be and or or')
+    resp = data_model.get_gate_set_cells(datasource, post_data['gate_sets'], combine, post_data.get('labels', False))
+    return serialize_and_submit_json(resp)
+
+
+# format=records (default) returns one object per cell, format=columns one
+# array per key, format=binary the arrays packed as gzipped binary, see
+# data_model._pack_columns.
 @app.route('/get_gated_cell_ids_custom', methods=['GET'])
 def get_gated_cell_ids_custom():
     datasource = request.args.get('datasource')
     filter = json.loads(request.args.get('filter'))
     start_keys = list(request.args.get('start_keys').split(','))
-    resp = data_model.get_gated_cells_custom(datasource, filter, start_keys)
+    session = request.args.get('session', '')
+    format = request.args.get('format', 'records')
+    if format not in ('records', 'columns', 'binary'):
+        abort(400, 'format must be records, columns or binary')
+    try:
+        resp = data_model.get_gated_cells_custom(datasource, filter, start_keys, session, format)
+    except ValueError as e:
+        abort(400, str(e))
+    if format == 'binary':
+        return serialize_and_submit_binary(resp)
     return serialize_and_submit_json(resp)
 
 @app.route('/get_channel_cell_ids', methods=['GET'])
@@ -190,14 +354,19 @@ def upload_channels():
 
 @app.route('/get_rect_cells', methods=['GET'])
 def get_rect_cells():
-    # Parse (rect - [x, y, r], channels [string])
+    # Parse (rect - [x0, y0, x1, y1] or a circle [x, y, r], channels [string])
     datasource = request.args.get('datasource')
     rect = [float(x) for x in request.args.get('rect').split(',')]
-    channels = request.args.get('channels')
-
-    # Retrieve cells - FIXME: Too slow - jam is stalling image loading
-    resp = data_model.get_rect_cells(datasource, rect, channels)
-    print('Neighborhood size:', len(resp))
+    if len(rect) not in (3, 4):
+        abort(400, 'rect must be x0,y0,x1,y1 or x,y,r')
+    channels = [channel for channel in request.args.get('channels', '').split(',') if channel != '']
+    # format=records (default) returns one object per cell, format=columns one array per column
+    format = request.args.get('format', 'records')
+    if format not in ('records', 'columns'):
+        abort(400, 'format must be records or columns')
+
+    # Retrieve cells
+    resp = data_model.get_rect_cells(datasource, rect, channels, format)
     return serialize_and_submit_json(resp)
 
 
@@ -227,9 +396,9 @@ def download_gating_csv():
     fullCsv = json.loads(request.form['fullCsv'])
     encoding = request.form['encoding']
     if fullCsv:
-        csv = data_model.download_gating_csv(datasource, filter, channels, selection_ids, encoding)
+        csv_chunks = data_model.download_gating_csv(datasource, filter, channels, selection_ids, encoding)
         return Response(
-            csv.to_csv(index=False),
+            csv_chunks,
             mimetype="text/csv",
             headers={"Content-disposition":
                          "attachment; filename=" + filename + ".csv"})
@@ -261,6 +430,59 @@ def get_saved_gating_list():
     resp = data_model.get_saved_gating_list(datasource)
     return serialize_and_submit_json(resp)
 
+# Named cell selections, stored as CellSets. cells is a list of IDs or an encoded CellSet of rows
+@app.route('/save_cell_set', methods=['POST'])
+def save_cell_set():
+    post_data = json.loads(request.data)
+    datasource = post_data['datasource']
+    count = data_model.save_cell_set(datasource, post_data['name'], post_data['cells'])
+    return serialize_and_submit_json({'success': True, 'count': count})
+
+@app.route('/get_saved_cell_set', methods=['GET'])
+def get_saved_cell_set():
+    datasource = request.args.get('datasource')
+    name = request.args.get('name')
+    encoding = request.args.get('encoding', 'ids')
+    resp = data_model.get_saved_cell_set(datasource, name, encoding)
+    if resp is None:
+        abort(404)
+    return serialize_and_submit_json(resp)
+
+# Hierarchical gating: nodes is a list of populations {id, parent, gates,
+# polygons}, each the cells of its parent (all cells without one) in its own
+# range gates {channel: [lo, hi]} and polygon gates {x, y, points} on two
+# channels. Returns the count of every node and of its parent population.
+@app.route('/get_gating_tree_counts', methods=['POST'])
+def get_gating_tree_counts():
+    post_data = json.loads(request.data)
+    datasource = post_data['datasource']
+    try:
+        resp = data_model.get_gating_tree_counts(datasource, post_data['nodes'], post_data.get('encoding'))
+    except ValueError as e:
+        abort(400, str(e))
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/save_gating_tree', methods=['POST'])
+def save_gating_tree():
+    post_data = json.loads(request.data)
+    datasource = post_data['datasource']
+    try:
+        data_model.save_gating_tree(datasource, post_data.get('name', 'default'), post_data['nodes'])
+    except ValueError as e:
+        abort(400, str(e))
+    return serialize_and_submit_json({'success': True})
+
+
+@app.route('/get_saved_gating_tree', methods=['GET'])
+def get_saved_gating_tree():
+    datasource = request.args.get('datasource')
+    name = request.args.get('name', 'default')
+    resp = data_model.get_saved_gating_tree(datasource, name)
+    if resp is None:
+        abort(404)
+    return serialize_and_submit_json(resp)
+
 @app.route('/download_channels_csv', methods=['POST'])
 def download_channels_csv():
     filename = request.form['filename']
@@ -323,14 +545,48 @@ def get_saved_channel_list():
 # E.G /generated/data/melanoma/channel_00_files/13/16_18.png
 @app.route('/generated/data/<string:datasource>/<string:channel>/<string:level>/<string:tile>')
 def generate_png(datasource, channel, level, tile):
-    now = time()
-    png = data_model.generate_zarr_png(datasource, channel, level, tile)
-    file_object = io.BytesIO()
-    # write PNG in file-object
-    Image.fromarray(png).save(file_object, 'PNG', compress_level=0)
-    # move to beginning of file so `send_file()` it will read from start
-    file_object.seek(0)
-    return send_file(file_object, mimetype='image/PNG')
+    png, etag = data_model.get_tile(datasource, channel, level, tile)
+    return submit_tile(png, etag, app.config['TILE_MAX_AGE'])
+
+# Overlay of the cells of a set on the segmentation mask, as transparent PNG
+# tiles laid out like the image's. The set is a saved cell set (cell_set=name)
+# or gates (filter, combine), filled with color (hex) at alpha (0-255).
+# E.G /generated/overlay/melanoma/13/16_18.png?cell_set=tumor
+@app.route('/generated/overlay/<string:datasource>/<string:level>/<string:tile>')
+def generate_overlay_png(datasource, level, tile):
+    cell_set = request.args.get('cell_set')
+    filter = request.args.get('filter')
+    if cell_set is None and filter is None:
+        abort(400, 'cell_set or filter is required')
+    combine = request.args.get('combine', 'and')
+    if combine not in ('and', 'or'):
+        abort(400, 'combine must be and or or')
+    resp = data_model.get_overlay_tile(datasource, level, tile, cell_set=cell_set,
+                                       gates=json.loads(filter) if filter is not None else None, combine=combine,
+                                       color=request.args.get('color', '#ffff00'),
+                                       alpha=int(request.args.get('alpha', 255)))
+    if resp is None:
+        abort(404)
+    # Saved cell sets change under the same URL, so overlays are revalidated by ETag on every use
+    png, etag = resp
+    return submit_tile(png, etag, 0)
+
+
+def submit_tile(png, etag, max_age):
+    """
+    Browsers may reuse the tile for max_age seconds, then revalidate it: a
+    matching If-None-Match gets a 304. With max_age 0 it is revalidated on
+    every use, for tiles whose content can change under the same URL.
+    """
+    response = make_response(png)
+    response.headers.set('Content-Type', 'image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if max_age > 0:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 def serialize_and_submit_json(data):
     response = app.response_class(
@@ -339,12 +595,22 @@ def serialize_and_submit_json(data):
     )
     return response
 
+def serialize_and_submit_binary(data):
+    content = gzip.compress(data)
+    response = make_response(content)
+    response.headers.set('Content-Type', 'application/octet-stream')
+    response.headers['Content-length'] = len(content)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 @app.route('/get_cells_in_polygon', methods=['POST'])
 def get_cells_in_polygon():
     post_data = json.loads(request.data)
     datasource = post_data['datasource']
     points = post_data['points']
-    resp = data_model.get_cells_in_polygon(datasource, points)
+    # encoding=cellset returns the cells as an encoded CellSet of rows instead of a list of IDs
+    encoding = post_data.get('encoding', 'ids')
+    resp = data_model.get_cells_in_polygon(datasource, points, encoding)
     return serialize_and_submit_json(resp)
 
 @app.route('/get_cells_in_lassos', methods=['POST'])
@@ -352,5 +618,6 @@ def get_cells_in_lassos():
     post_data = json.loads(request.data)
     datasource = post_data['datasource']
     list_lassos = post_data['list_lassos']
-    resp = data_model.get_cells_in_lassos(datasource, list_lassos)
+    encoding = post_data.get('encoding', 'ids')
+    resp = data_model.get_cells_in_lassos(datasource, list_lassos, encoding)
     return serialize_and_submit_json(resp)
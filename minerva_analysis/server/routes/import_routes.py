@@ -2,7 +2,7 @@
 
 # import sys
 # sys.path.append('/c/Users/Sophie/minerva_analysis/')
-from minerva_analysis import app, get_config_names, config_json_path, data_path, cwd_path
+from minerva_analysis import app, get_config, get_config_names, write_config, data_path, cwd_path
 from minerva_analysis.server.utils import mostFrequentLongestSubstring, pre_normalization
 from minerva_analysis.server.models import data_model
 
@@ -40,127 +40,120 @@ def edit_config_with_request_name(config_name):
 
 @app.route('/delete/<string:config_name>')
 def delete_with_datasource_name(config_name):
-    global config_json_path
-
+    data_model.unload_datasource(config_name)
     path = str(data_path / config_name)
     if Path(path).exists():
         shutil.rmtree(path)
-    with open(config_json_path, "r+") as configJson:
-        config_data = json.load(configJson)
-        del config_data[config_name]
-        configJson.seek(0)  # <--- should reset file position to the beginning.
-        json.dump(config_data, configJson, indent=4)
-        configJson.truncate()
+    config_data = dict(get_config())
+    del config_data[config_name]
+    write_config(config_data)
     return render_template("index.html", data={'datasource': '', 'datasources': get_config_names()})
 
 
 def edit_config_with_config_name(config_name):
     data = {}
-    global config_json_path
-    with open(config_json_path, "r+") as configJson:
-        config_csv = json.load(configJson)
-        config_data = config_csv[config_name]
-        data['datasetName'] = config_name
-        # test_data['channelFileNames'] = ['channel_01', 'channel_02']
-        data['csvName'] = config_data['featureData'][0]['src'].split("/")[-1]
-        if 'celltypeData' in config_data['featureData'][0]:
-            data['celltypeData'] = config_data['featureData'][0]['celltypeData']
-
-        if 'shapes' in config_data:
-            data['shapes'] = config_data['shapes']
-
-        if 'activeChannel' in config_data:
-            data['activeChannel'] = config_data['activeChannel']
-
-        if 'normalization' in config_data['featureData'][0]:
-            data['normalization'] = config_data['featureData'][0]['normalization']
-
-        if 'isTransformed' in config_data['featureData'][0]:
-            data['isTransformed'] = config_data['featureData'][0]['isTransformed']
-
-        if 'clusterData' in config_data:
-            data['normCsvName'] = config_data['clusterData']
-
-        if 'maxLevel' in config_data:
-            data['maxLevel'] = config_data['maxLevel']
-        if 'height' in config_data:
-            data['height'] = config_data['height']
-
-        if 'width' in config_data:
-            data['width'] = config_data['width']
-
-        if 'segmentation' in config_data:
-            data['segmentation'] = config_data['segmentation']
-
-        if 'channelFile' in config_data:
-            data['channelFile'] = config_data['channelFile']
-
-        if 'num_channels' in config_data:
-            data['num_channels'] = config_data['num_channels']
-
-        if 'tileHeight' in config_data:
-            data['tileHeight'] = config_data['tileHeight']
-
-        if 'tileWidth' in config_data:
-            data['tileWidth'] = config_data['tileWidth']
-
-        csvHeaders = []
-        channelFileNames = []
-        if 'idField' in config_data['featureData'][0]:
-            data['idField'] = True
-            elem = {}
-            elem['fullName'] = config_data['featureData'][0]['idField']
-            elem['displayName'] = config_data['featureData'][0]['idField']
-            csvHeaders.append(elem)
-            channelFileNames = ['ID']
-        else:
-            data['idField'] = False;
-        # add x cord
+    config_data = get_config()[config_name]
+    data['datasetName'] = config_name
+    # test_data['channelFileNames'] = ['channel_01', 'channel_02']
+    data['csvName'] = config_data['featureData'][0]['src'].split("/")[-1]
+    if 'celltypeData' in config_data['featureData'][0]:
+        data['celltypeData'] = config_data['featureData'][0]['celltypeData']
+
+    if 'shapes' in config_data:
+        data['shapes'] = config_data['shapes']
+
+    if 'activeChannel' in config_data:
+        data['activeChannel'] = config_data['activeChannel']
+
+    if 'normalization' in config_data['featureData'][0]:
+        data['normalization'] = config_data['featureData'][0]['normalization']
+
+    if 'isTransformed' in config_data['featureData'][0]:
+        data['isTransformed'] = config_data['featureData'][0]['isTransformed']
+
+    if 'clusterData' in config_data:
+        data['normCsvName'] = config_data['clusterData']
+
+    if 'maxLevel' in config_data:
+        data['maxLevel'] = config_data['maxLevel']
+    if 'height' in config_data:
+        data['height'] = config_data['height']
+
+    if 'width' in config_data:
+        data['width'] = config_data['width']
+
+    if 'segmentation' in config_data:
+        data['segmentation'] = config_data['segmentation']
+
+    if 'channelFile' in config_data:
+        data['channelFile'] = config_data['channelFile']
+
+    if 'num_channels' in config_data:
+        data['num_channels'] = config_data['num_channels']
+
+    if 'tileHeight' in config_data:
+        data['tileHeight'] = config_data['tileHeight']
+
+    if 'tileWidth' in config_data:
+        data['tileWidth'] = config_data['tileWidth']
+
+    csvHeaders = []
+    channelFileNames = []
+    if 'idField' in config_data['featureData'][0]:
+        data['idField'] = True
         elem = {}
-        elem['fullName'] = config_data['featureData'][0]['xCoordinate']
-        elem['displayName'] = config_data['featureData'][0]['xCoordinate']
+        elem['fullName'] = config_data['featureData'][0]['idField']
+        elem['displayName'] = config_data['featureData'][0]['idField']
         csvHeaders.append(elem)
-        # add y cord
+        channelFileNames = ['ID']
+    else:
+        data['idField'] = False;
+    # add x cord
+    elem = {}
+    elem['fullName'] = config_data['featureData'][0]['xCoordinate']
+    elem['displayName'] = config_data['featureData'][0]['xCoordinate']
+    csvHeaders.append(elem)
+    # add y cord
+    elem = {}
+    elem['fullName'] = config_data['featureData'][0]['yCoordinate']
+    elem['displayName'] = config_data['featureData'][0]['yCoordinate']
+    csvHeaders.append(elem)
+    # add cell type
+    if 'celltypeData' in config_data['featureData'][0]:
         elem = {}
-        elem['fullName'] = config_data['featureData'][0]['yCoordinate']
-        elem['displayName'] = config_data['featureData'][0]['yCoordinate']
+        elem['fullName'] = config_data['featureData'][0]['celltype']
+        elem['displayName'] = config_data['featureData'][0]['celltype']
         csvHeaders.append(elem)
-        # add cell type
-        if 'celltypeData' in config_data['featureData'][0]:
-            elem = {}
-            elem['fullName'] = config_data['featureData'][0]['celltype']
-            elem['displayName'] = config_data['featureData'][0]['celltype']
-            csvHeaders.append(elem)
-
-        # Start with the required channels
-        if 'celltypeData' in config_data['featureData'][0]:
-            channelFileNames.extend(['Area', 'X Position', 'Y Position', 'Cell Type'])
-        else:
-            channelFileNames.extend(['Area', 'X Position', 'Y Position'])
-
-        for i in range(len(config_data['imageData'])):
-            elem = config_data['imageData'][i]
-            channelName = elem['src'].split("/")[-2]
-            header = {}
-            header['fullName'] = elem['fullname']
-            header['displayName'] = elem['name']
-            # Special handling for label channel
-            if i == 0:
-                data['labelName'] = channelName
-                if data['idField']:
-                    csvHeaders.insert(1, header)
-                else:
-                    csvHeaders.insert(0, header)
+
+    # Start with the required channels
+    if 'celltypeData' in config_data['featureData'][0]:
+        channelFileNames.extend(['Area', 'X Position', 'Y Position', 'Cell Type'])
+    else:
+        channelFileNames.extend(['Area', 'X Position', 'Y Position'])
+
+    for i in range(len(config_data['imageData'])):
+        elem = config_data['imageData'][i]
+        channelName = elem['src'].split("/")[-2]
+        header = {}
+        header['fullName'] = elem['fullname']
+        header['displayName'] = elem['name']
+        # Special handling for label channel
+        if i == 0:
+            data['labelName'] = channelName
+            if data['idField']:
+                csvHeaders.insert(1, header)
             else:
-                channelFileNames.append(channelName)
-                csvHeaders.append(header)
+                csvHeaders.insert(0, header)
+        else:
+            channelFileNames.append(channelName)
+            csvHeaders.append(header)
 
-        data['csvHeader'] = csvHeaders
-        header_full_names = [elem['displayName'] for elem in csvHeaders]
-        data['substring'] = mostFrequentLongestSubstring.find_substring(header_full_names)
-        data['channelFileNames'] = channelFileNames
-        data['datasources'] = [key for key in config_csv.keys()]
-        return render_template('channel_match.html', data=data)
+    data['csvHeader'] = csvHeaders
+    header_full_names = [elem['displayName'] for elem in csvHeaders]
+    data['substring'] = mostFrequentLongestSubstring.find_substring(header_full_names)
+    data['channelFileNames'] = channelFileNames
+    data['datasources'] = [key for key in get_config().keys()]
+    return render_template('channel_match.html', data=data)
 
 
 @app.route('/upload', methods=['GET', 'POST'])
@@ -370,7 +363,6 @@ def channel():
 
 @app.route('/save_config', methods=['POST'])
 def save_config():
-    global config_json_path
     try:
         originalData = request.json['originalData']
         datasetName = originalData['datasetName']
@@ -408,98 +400,95 @@ def save_config():
 
         headerList = [x for x in zip(headerList[1::3], headerList[0::3])]
         channelList = originalData['channelFileNames']
-        with open(config_json_path, "r+") as configJson:
-            configData = json.load(configJson)
-            configData[datasetName] = {}
-            configData[datasetName]['shapes'] = ''
-            if normCsvName:
-                configData[datasetName]['clusterData'] = normCsvName
-            configData[datasetName]['activeChannel'] = ''
-            configData[datasetName]['featureData'] = [{}]
-            configData[datasetName]['featureData'][0]['normalization'] = 'none'
-            if 'celltypeData' in originalData:
-                configData[datasetName]['featureData'][0]['celltypeData'] = str(data_path / datasetName / celltypeName)
-                configData[datasetName]['featureData'][0]['celltype'] = headerList[3][1]['value']
-            configData[datasetName]['featureData'][0]['xCoordinate'] = headerList[1][1]['value']
-            configData[datasetName]['featureData'][0]['yCoordinate'] = headerList[2][1]['value']
+        configData = dict(get_config())
+        configData[datasetName] = {}
+        configData[datasetName]['shapes'] = ''
+        if normCsvName:
+            configData[datasetName]['clusterData'] = normCsvName
+        configData[datasetName]['activeChannel'] = ''
+        configData[datasetName]['featureData'] = [{}]
+        configData[datasetName]['featureData'][0]['normalization'] = 'none'
+        if 'celltypeData' in originalData:
+            configData[datasetName]['featureData'][0]['celltypeData'] = str(data_path / datasetName / celltypeName)
+            configData[datasetName]['featureData'][0]['celltype'] = headerList[3][1]['value']
+        configData[datasetName]['featureData'][0]['xCoordinate'] = headerList[1][1]['value']
+        configData[datasetName]['featureData'][0]['yCoordinate'] = headerList[2][1]['value']
 
-            # If optional id field
-            if 'idField' in request.json:
-                channelList.pop(0)
-                configData[datasetName]['featureData'][0]['idField'] = request.json['idField'][1]['value']
+        # If optional id field
+        if 'idField' in request.json:
+            channelList.pop(0)
+            configData[datasetName]['featureData'][0]['idField'] = request.json['idField'][1]['value']
 
-            if 'shapes' in originalData:
-                configData[datasetName]['shapes'] = originalData['shapes']
+        if 'shapes' in originalData:
+            configData[datasetName]['shapes'] = originalData['shapes']
 
-            if 'height' in originalData:
-                configData[datasetName]['height'] = originalData['height']
+        if 'height' in originalData:
+            configData[datasetName]['height'] = originalData['height']
 
-            if 'width' in originalData:
-                configData[datasetName]['width'] = originalData['width']
+        if 'width' in originalData:
+            configData[datasetName]['width'] = originalData['width']
 
-            if 'maxLevel' in originalData:
-                configData[datasetName]['maxLevel'] = originalData['maxLevel']
+        if 'maxLevel' in originalData:
+            configData[datasetName]['maxLevel'] = originalData['maxLevel']
 
-            if 'num_channels' in originalData:
-                configData[datasetName]['num_channels'] = originalData['num_channels']
+        if 'num_channels' in originalData:
+            configData[datasetName]['num_channels'] = originalData['num_channels']
 
-            if 'tileWidth' in originalData:
-                configData[datasetName]['tileWidth'] = originalData['tileWidth']
+        if 'tileWidth' in originalData:
+            configData[datasetName]['tileWidth'] = originalData['tileWidth']
 
-            if 'tileHeight' in originalData:
-                configData[datasetName]['tileHeight'] = originalData['tileHeight']
+        if 'tileHeight' in originalData:
+            configData[datasetName]['tileHeight'] = originalData['tileHeight']
 
-            if 'segmentation' in originalData:
-                configData[datasetName]['segmentation'] = originalData['segmentation']
+        if 'segmentation' in originalData:
+            configData[datasetName]['segmentation'] = originalData['segmentation']
 
-            if 'channelFile' in originalData:
-                configData[datasetName]['channelFile'] = originalData['channelFile']
+        if 'channelFile' in originalData:
+            configData[datasetName]['channelFile'] = originalData['channelFile']
 
-            if 'activeChannel' in originalData:
-                configData[datasetName]['activeChannel'] = originalData['activeChannel']
+        if 'activeChannel' in originalData:
+            configData[datasetName]['activeChannel'] = originalData['activeChannel']
 
-            if 'normalization' in originalData:
-                configData[datasetName]['featureData'][0]['normalization'] = originalData['normalization']
+        if 'normalization' in originalData:
+            configData[datasetName]['featureData'][0]['normalization'] = originalData['normalization']
 
-            if isTransformed or transformData:
-                configData[datasetName]['featureData'][0]['isTransformed'] = True
-            else:
-                configData[datasetName]['featureData'][0]['isTransformed'] = False
-
-            configData[datasetName]['featureData'][0][
-                'src'] = str(data_path / datasetName / csvName)
-            # Adding the Label Channel as the First Label
-            configData[datasetName]['imageData'] = [{}]
-            configData[datasetName]['imageData'][0]['name'] = headerList[0][1]['value']
-            configData[datasetName]['imageData'][0]['fullname'] = 'Area'
-            if 'labelName' in originalData and originalData['labelName'] != '':
-                configData[datasetName]['imageData'][0]['src'] = "/generated/data/" + datasetName + "/" + originalData[
-                    'labelName'] + "/"
-            else:
-                configData[datasetName]['imageData'][0]['src'] = ''
+        if isTransformed or transformData:
+            configData[datasetName]['featureData'][0]['isTransformed'] = True
+        else:
+            configData[datasetName]['featureData'][0]['isTransformed'] = False
+
+        configData[datasetName]['featureData'][0][
+            'src'] = str(data_path / datasetName / csvName)
+        # Adding the Label Channel as the First Label
+        configData[datasetName]['imageData'] = [{}]
+        configData[datasetName]['imageData'][0]['name'] = headerList[0][1]['value']
+        configData[datasetName]['imageData'][0]['fullname'] = 'Area'
+        if 'labelName' in originalData and originalData['labelName'] != '':
+            configData[datasetName]['imageData'][0]['src'] = "/generated/data/" + datasetName + "/" + originalData[
+                'labelName'] + "/"
+        else:
+            configData[datasetName]['imageData'][0]['src'] = ''
 
-            if 'celltypeData' in originalData:
-                channelList = channelList[4:]
-            else:
-                channelList = channelList[3:]
+        if 'celltypeData' in originalData:
+            channelList = channelList[4:]
+        else:
+            channelList = channelList[3:]
 
-            if 'celltypeData' in originalData:
-                channelStart = 4
-            else:
-                channelStart = 3
-            for i in range(len(channelList)):
-                channel = channelList[i]
-                channelData = {}
-                channelData['src'] = "/generated/data/" + datasetName + "/" + channel + "/"
-                channelData['name'] = headerList[i + channelStart][0]['value']
-                channelData['fullname'] = headerList[i + channelStart][1]['value']
-                configData[datasetName]['imageData'].append(channelData)
-            configJson.seek(0)  # <--- should reset file position to the beginning.
-            json.dump(configData, configJson, indent=4)
-            configJson.truncate()
-            data_model.load_datasource(datasetName, reload=True)
-            resp = jsonify(success=True)
-            return resp
+        if 'celltypeData' in originalData:
+            channelStart = 4
+        else:
+            channelStart = 3
+        for i in range(len(channelList)):
+            channel = channelList[i]
+            channelData = {}
+            channelData['src'] = "/generated/data/" + datasetName + "/" + channel + "/"
+            channelData['name'] = headerList[i + channelStart][0]['value']
+            channelData['fullname'] = headerList[i + channelStart][1]['value']
+            configData[datasetName]['imageData'].append(channelData)
+        write_config(configData)
+        data_model.init(datasetName, reload=True)
+        resp = jsonify(success=True)
+        return resp
 
     except Exception as e:
         resp = jsonify(success=False)
@@ -631,8 +620,8 @@ def check_dataset_exists():
 @app.route('/init_datasource', methods=['GET'])
 def init_datasource():
     datasource = request.args.get('datasource')
-    data_model.init(datasource)
-    resp = jsonify(success=True)
+    status = data_model.init(datasource)
+    resp = jsonify(success=True, status=status)
     return resp
 
 
@@ -0,0 +1,250 @@
+# Compressed bitmap sets of table rows, for gates, lassos and selections.
+#
+# Rows are split into chunks of 2 ** 16 by their high bits, like a roaring
+# bitmap. A chunk holding few rows stores their low 16 bits as a sorted uint16
+# array, a chunk holding more stores a bitmap of 1024 uint64 words, whichever
+# is smaller. Sets are immutable: operations return new sets (sharing unchanged
+# chunks).
+#
+# Wire encoding (little-endian): the magic b'CSET', a version byte and the
+# number of chunks (uint32), then for every chunk in order its key (uint32),
+# kind (uint8, 0 array, 1 bitmap), number of rows (uint32) and its uint16
+# array or 8192 byte bitmap. to_base64 wraps that for JSON.
+import base64
+import struct
+
+import numpy as np
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+BITMAP_WORDS = CHUNK_SIZE // 64
+# Chunks with more rows than this are stored as bitmaps
+ARRAY_MAX = 4096
+MAGIC = b'CSET'
+VERSION = 1
+ARRAY, BITMAP = 0, 1
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+_HEADER = struct.Struct('<4sBI')
+_CHUNK_HEADER = struct.Struct('<IBI')
+
+
+class CellSet:
+    """
+    Set of table rows (non-negative integers below 2 ** 48). Supports len, in,
+    iteration in increasing order, ==, and | & - for union, intersection and
+    difference.
+    """
+
+    def __init__(self, chunks=None):
+        # Chunk key -> (kind, uint16 array or uint64 bitmap, number of rows), without empty chunks
+        self._chunks = dict(sorted((chunks or {}).items()))
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if len(rows) > 0 and rows[0] < 0:
+            raise ValueError('Rows must not be negative')
+        keys = rows >> CHUNK_BITS
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(rows) > 0 else []
+        stops = list(starts[1:]) + [len(rows)]
+        chunks = {}
+        for start, stop in zip(starts, stops):
+            chunks[int(keys[start])] = _container((rows[start:stop] & (CHUNK_SIZE - 1)).astype(np.uint16))
+        return cls(chunks)
+
+    @classmethod
+    def from_mask(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        chunks = {}
+        for key, start in enumerate(range(0, len(mask), CHUNK_SIZE)):
+            chunk = mask[start:start + CHUNK_SIZE]
+            count = int(np.count_nonzero(chunk))
+            if count > ARRAY_MAX:
+                padded = np.zeros(CHUNK_SIZE, dtype=bool)
+                padded[:len(chunk)] = chunk
+                chunks[key] = (BITMAP, np.packbits(padded, bitorder='little').view('<u8'), count)
+            elif count > 0:
+                chunks[key] = (ARRAY, np.flatnonzero(chunk).astype(np.uint16), count)
+        return cls(chunks)
+
+    @classmethod
+    def full(cls, num_rows):
+        # All rows below num_rows
+        return cls.from_mask(np.ones(num_rows, dtype=bool))
+
+    def __len__(self):
+        return sum(count for kind, values, count in self._chunks.values())
+
+    def __contains__(self, row):
+        row = int(row)
+        chunk = self._chunks.get(row >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = row & (CHUNK_SIZE - 1)
+        if chunk[0] == BITMAP:
+            return bool((int(chunk[1][low >> 6]) >> (low & 63)) & 1)
+        i = np.searchsorted(chunk[1], low)
+        return bool(i < len(chunk[1]) and chunk[1][i] == low)
+
+    def __iter__(self):
+        return iter(self.to_rows().tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, CellSet):
+            return NotImplemented
+        return len(self) == len(other) and np.array_equal(self.to_rows(), other.to_rows())
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def resident_bytes(self):
+        return sum(values.nbytes for kind, values, count in self._chunks.values())
+
+    def to_rows(self):
+        # Rows in increasing order
+        parts = [(key << CHUNK_BITS) + _lows(chunk).astype(np.int64) for key, chunk in self._chunks.items()]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def to_mask(self, num_rows):
+        # Boolean mask over num_rows rows, rows beyond it are left out
+        mask = np.zeros(num_rows, dtype=bool)
+        for key, chunk in self._chunks.items():
+            start = key << CHUNK_BITS
+            if start >= num_rows:
+                break
+            if chunk[0] == BITMAP:
+                bits = np.unpackbits(chunk[1].view(np.uint8), bitorder='little').view(bool)
+                mask[start:start + CHUNK_SIZE] = bits[:min(CHUNK_SIZE, num_rows - start)]
+            else:
+                lows = chunk[1][chunk[1] < num_rows - start]
+                mask[start + lows.astype(np.int64)] = True
+        return mask
+
+    def union(self, other):
+        chunks = dict(self._chunks)
+        for key, chunk in other._chunks.items():
+            mine = chunks.get(key)
+            if mine is None:
+                chunks[key] = chunk
+            elif mine[0] == ARRAY and chunk[0] == ARRAY:
+                chunks[key] = _container(np.union1d(mine[1], chunk[1]).astype(np.uint16))
+            else:
+                chunks[key] = _from_bitmap(_bitmap(mine) | _bitmap(chunk))
+        return CellSet(chunks)
+
+    def intersection(self, other):
+        chunks = {}
+        for key, mine in self._chunks.items():
+            chunk = other._chunks.get(key)
+            if chunk is None:
+                continue
+            if mine[0] == BITMAP and chunk[0] == BITMAP:
+                result = _from_bitmap(mine[1] & chunk[1])
+            elif mine[0] == ARRAY and chunk[0] == ARRAY:
+                result = _container(np.intersect1d(mine[1], chunk[1], assume_unique=True).astype(np.uint16))
+            else:
+                values, bitmap = (mine[1], chunk) if mine[0] == ARRAY else (chunk[1], mine)
+                result = _container(values[_test(bitmap[1], values)])
+            if result is not None:
+                chunks[key] = result
+        return CellSet(chunks)
+
+    def difference(self, other):
+        chunks = {}
+        for key, mine in self._chunks.items():
+            chunk = other._chunks.get(key)
+            if chunk is None:
+                result = mine
+            elif mine[0] == ARRAY and chunk[0] == ARRAY:
+                result = _container(np.setdiff1d(mine[1], chunk[1], assume_unique=True).astype(np.uint16))
+            elif mine[0] == ARRAY:
+                result = _container(mine[1][~_test(chunk[1], mine[1])])
+            else:
+                result = _from_bitmap(mine[1] & ~_bitmap(chunk))
+            if result is not None:
+                chunks[key] = result
+        return CellSet(chunks)
+
+    def complement(self, num_rows):
+        # Rows below num_rows not in the set
+        return CellSet.full(num_rows) - self
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(MAGIC, VERSION, len(self._chunks))]
+        for key, (kind, values, count) in self._chunks.items():
+            parts.append(_CHUNK_HEADER.pack(key, kind, count))
+            parts.append(values.astype('<u2' if kind == ARRAY else '<u8').tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        magic, version, num_chunks = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not an encoded cell set')
+        offset = _HEADER.size
+        chunks = {}
+        for i in range(num_chunks):
+            key, kind, count = _CHUNK_HEADER.unpack_from(data, offset)
+            offset += _CHUNK_HEADER.size
+            if kind == ARRAY:
+                values = np.frombuffer(data, dtype='<u2', count=count, offset=offset).astype(np.uint16)
+                offset += 2 * count
+            elif kind == BITMAP:
+                values = np.frombuffer(data, dtype='<u8', count=BITMAP_WORDS, offset=offset).astype(np.uint64)
+                offset += 8 * BITMAP_WORDS
+            else:
+                raise ValueError('Unknown chunk kind ' + str(kind))
+            chunks[key] = (kind, values, count)
+        return cls(chunks)
+
+    def to_base64(self):
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def from_base64(cls, text):
+        return cls.from_bytes(base64.b64decode(text))
+
+
+def _container(lows):
+    # The smaller container for the sorted low bits of a chunk's rows, None if there are none
+    if len(lows) == 0:
+        return None
+    if len(lows) > ARRAY_MAX:
+        return _from_bitmap(_bitmap((ARRAY, lows, len(lows))))
+    return ARRAY, lows, len(lows)
+
+
+def _from_bitmap(bitmap):
+    count = int(_POPCOUNT[bitmap.view(np.uint8)].sum())
+    if count == 0:
+        return None
+    if count <= ARRAY_MAX:
+        return ARRAY, _lows((BITMAP, bitmap, count)), count
+    return BITMAP, bitmap, count
+
+
+def _bitmap(chunk):
+    if chunk[0] == BITMAP:
+        return chunk[1]
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[chunk[1]] = True
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+def _lows(chunk):
+    if chunk[0] == ARRAY:
+        return chunk[1]
+    return np.flatnonzero(np.unpackbits(chunk[1].view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+def _test(bitmap, lows):
+    # Whether each of lows is set in bitmap
+    words = bitmap[lows >> 6]
+    return ((words >> (lows & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
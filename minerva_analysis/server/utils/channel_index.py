@@ -0,0 +1,126 @@
+# Sorted indexes of channel columns, for range gates that select few cells.
+#
+# A channel's index is the permutation sorting its column, stored with the
+# sorted values, so the rows whose values lie in a range are one slice of it
+# found with two binary searches instead of a scan of the whole column. On
+# disk an index is a directory of two .npy files, memory-mapped when opened:
+#   values.npy   the column's values in increasing order (missing ones last)
+#   rows.npy     the row of every value
+import hashlib
+import os
+import re
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+
+class SortedIndex:
+    def __init__(self, values, rows):
+        self.values = values
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def resident_bytes(self):
+        # Memory-mapped arrays are paged in and out by the OS and are not counted
+        return sum(array.nbytes for array in (self.values, self.rows) if not isinstance(array, np.memmap))
+
+    def count(self, lo, hi):
+        # Number of rows with lo < value < hi
+        start, stop = self._span(lo, hi)
+        return stop - start
+
+    def range_rows(self, lo, hi):
+        # Rows with lo < value < hi, in the order of their values
+        start, stop = self._span(lo, hi)
+        return self.rows[start:stop]
+
+    def find(self, values):
+        # Rows holding each of values (the first of repeated ones), values not found are left out
+        values = np.asarray(values)
+        if len(self.values) == 0 or len(values) == 0:
+            return np.empty(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.values, values), len(self.values) - 1)
+        found = self.values[positions] == values
+        return np.asarray(self.rows[positions[found]], dtype=np.int64)
+
+    def _span(self, lo, hi):
+        start = self._first_above(lo)
+        stop = self._first_not_below(hi)
+        return start, max(start, stop)
+
+    def _cast(self, bound):
+        # The bound in the dtype of the values: searching with a wider type would
+        # convert the whole (memory-mapped) array. The result is then corrected
+        # by comparing with the exact bound.
+        dtype = self.values.dtype
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            bound = min(max(bound, info.min), info.max)
+        return np.asarray(bound).astype(dtype)
+
+    def _first_above(self, bound):
+        # Position of the first value > bound
+        values = self.values
+        i = int(np.searchsorted(values, self._cast(bound), side='left'))
+        while i < len(values) and not values[i] > bound:
+            i = int(np.searchsorted(values, values[i], side='right'))
+        return i
+
+    def _first_not_below(self, bound):
+        # Position of the first value >= bound, missing values count as >= any bound
+        values = self.values
+        i = int(np.searchsorted(values, self._cast(bound), side='left'))
+        while i > 0 and values[i - 1] >= bound:
+            i = int(np.searchsorted(values, values[i - 1], side='left'))
+        while i < len(values) and values[i] < bound:
+            i = int(np.searchsorted(values, values[i], side='right'))
+        return i
+
+
+def index_name(channel):
+    # Directory name of a channel's index, safe for any column name
+    digest = hashlib.blake2b(channel.encode('utf-8'), digest_size=4).hexdigest()
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', channel) + '-' + digest
+
+
+def build(values, index_dir):
+    # Builds the index of the column values and writes it to index_dir
+    values = np.asarray(values)
+    order = np.argsort(values, kind='stable')
+    rows = order.astype(np.uint32) if len(order) < 2 ** 32 else order
+
+    index_dir = Path(index_dir)
+    tmp_dir = index_dir.with_name(index_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    np.save(tmp_dir / 'values.npy', values[order], allow_pickle=False)
+    np.save(tmp_dir / 'rows.npy', rows, allow_pickle=False)
+    if index_dir.exists():
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+    return load(index_dir)
+
+
+def load(index_dir):
+    # Returns the index stored in index_dir, None if there is no usable one
+    index_dir = Path(index_dir)
+    try:
+        rows = _load_array(index_dir / 'rows.npy')
+        values = _load_array(index_dir / 'values.npy')
+    except (OSError, ValueError):
+        return None
+    if len(rows) != len(values):
+        return None
+    return SortedIndex(values, rows)
+
+
+def _load_array(path):
+    try:
+        return np.load(path, allow_pickle=False, mmap_mode='r')
+    except ValueError:
+        # Empty arrays cannot be memory-mapped
+        return np.load(path, allow_pickle=False)
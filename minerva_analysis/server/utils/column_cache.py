@@ -0,0 +1,408 @@
+# Persisted columnar copy of a feature table.
+#
+# Every column of the parsed CSV is written as its own .npy file next to the
+# dataset, together with a manifest describing the source file it was built
+# from. Reopening the dataset memory-maps those files instead of parsing the
+# CSV again, and only the columns that are actually used are read; the cache
+# is rebuilt whenever the source size, mtime or content changes.
+#
+# The CSV is converted a chunk of rows at a time, so tables larger than memory
+# can be loaded.
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from minerva_analysis.server.utils.fingerprint import file_hash, of_file
+from minerva_analysis.server.utils.lru_cache import LRUCache
+
+CACHE_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+# Rows parsed at a time when converting a CSV
+CHUNK_ROWS = 250000
+
+
+class MixedColumnTypes(Exception):
+    # A column holds text in some chunks and numbers in others
+    pass
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(Path(cache_dir) / MANIFEST_NAME, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_valid(cache_dir, csv_path, options=None):
+    """
+    Returns the manifest if the cache in cache_dir was built from the current
+    contents of csv_path with the same options, None otherwise. The content hash
+    is only computed when size matches but mtime does not (e.g. the file was
+    copied or touched).
+    """
+    manifest = read_manifest(cache_dir)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return None
+    if manifest.get('options') != (options or {}):
+        return None
+    current = of_file(csv_path)
+    source = manifest['source']
+    if current['path'] != source['path'] or current['size'] != source['size']:
+        return None
+    if current['mtime_ns'] != source['mtime_ns']:
+        if file_hash(csv_path) != source['hash']:
+            return None
+        manifest['source']['mtime_ns'] = current['mtime_ns']
+        _write_manifest(cache_dir, manifest)
+    return manifest
+
+
+def clean_infinities(df):
+    # Column by column and in place, unlike df.replace, which copies the whole table
+    for name in df.columns:
+        if pd.api.types.is_float_dtype(df[name].dtype):
+            neg_inf = np.isneginf(df[name].to_numpy())
+            if neg_inf.any():
+                df.loc[neg_inf, name] = 0
+    return df
+
+
+def compact_dtypes(df, keep=()):
+    """
+    Converts float columns to float32, non-negative integer columns that fit to
+    uint32 and text columns to categoricals, one column at a time. Columns in
+    keep (e.g. coordinates) are left as they are.
+    """
+    original_nbytes = int(df.memory_usage(index=False, deep=True).sum())
+    for name in df.columns:
+        if name in keep:
+            continue
+        dtype = df[name].dtype
+        if pd.api.types.is_float_dtype(dtype) and dtype != np.float32:
+            df[name] = df[name].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(dtype) and dtype != np.uint32 and len(df) > 0:
+            values = df[name].to_numpy()
+            if values.min() >= 0 and values.max() <= np.iinfo(np.uint32).max:
+                df[name] = values.astype(np.uint32)
+        elif dtype == object:
+            df[name] = df[name].astype('category')
+    df.attrs['original_nbytes'] = original_nbytes
+    return df
+
+
+def read_chunks(csv_path, chunk_rows=CHUNK_ROWS, prepare=None, progress=None):
+    # Yields the table chunk_rows rows at a time, calling progress with the fraction of the file read
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as f:
+        for chunk in pd.read_csv(f, chunksize=chunk_rows):
+            if prepare is not None:
+                chunk = prepare(chunk)
+            yield chunk
+            if progress is not None and size > 0:
+                progress(min(f.tell() / size, 1.0))
+
+
+def write(df, cache_dir, csv_path, options=None):
+    return write_chunks([df], cache_dir, csv_path, options)
+
+
+def write_chunks(chunks, cache_dir, csv_path, options=None):
+    """
+    Writes the cache from consecutive row ranges of a table, holding only one of
+    them in memory at a time. Each column is written in parts that are joined
+    once the type it needs to hold every chunk is known, like pandas does when
+    it parses a whole file.
+    """
+    cache_dir = Path(cache_dir)
+    tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    names = None
+    parts = {}
+    dtypes = {}
+    # Text columns: category -> code, in order of appearance
+    categories = {}
+    as_object = {}
+    nbytes = {}
+    num_rows = 0
+    original_nbytes = 0
+    for chunk_num, chunk in enumerate(chunks):
+        if names is None:
+            names = list(chunk.columns)
+            for name in names:
+                parts[name] = []
+                dtypes[name] = []
+                nbytes[name] = 0
+                if _is_text(chunk[name]):
+                    categories[name] = {}
+                    # Text columns are handed back as they were parsed unless they were made categorical
+                    as_object[name] = chunk[name].dtype == object
+        elif list(chunk.columns) != names:
+            raise ValueError('Chunks of ' + str(csv_path) + ' have different columns')
+        for i, name in enumerate(names):
+            column = chunk[name]
+            if name in categories:
+                values = _category_codes(name, column, categories[name])
+            elif _is_text(column):
+                raise MixedColumnTypes('Column ' + name + ' mixes text and numbers')
+            else:
+                values = column.to_numpy()
+                dtypes[name].append(values.dtype)
+            nbytes[name] += int(column.memory_usage(index=False, deep=True))
+            part = tmp_dir / ('col_%05d.part%05d.npy' % (i, chunk_num))
+            np.save(part, np.ascontiguousarray(values), allow_pickle=False)
+            parts[name].append(part)
+        num_rows += len(chunk)
+        original_nbytes += chunk.attrs.get('original_nbytes', int(chunk.memory_usage(index=False, deep=True).sum()))
+    if names is None:
+        raise ValueError(str(csv_path) + ' has no header')
+
+    columns = []
+    for i, name in enumerate(names):
+        entry = {'name': name, 'file': 'col_%05d.npy' % i}
+        remap = None
+        if name in categories:
+            entry['kind'] = 'categorical'
+            entry['categories'], remap = _sorted_categories(categories[name])
+            entry['as_object'] = as_object[name]
+            dtype = np.min_scalar_type(-len(remap))
+            if not entry['as_object']:
+                nbytes[name] = num_rows * dtype.itemsize + int(pd.Index(entry['categories']).memory_usage(deep=True))
+        else:
+            entry['kind'] = 'array'
+            dtype = _common_dtype(dtypes[name])
+            nbytes[name] = num_rows * dtype.itemsize
+        _join_parts(parts[name], tmp_dir / entry['file'], dtype, num_rows, remap)
+        entry['nbytes'] = nbytes[name]
+        columns.append(entry)
+
+    source = of_file(csv_path)
+    source['hash'] = file_hash(csv_path)
+    total_nbytes = sum(entry['nbytes'] for entry in columns)
+    manifest = {'version': CACHE_VERSION, 'source': source, 'options': options or {}, 'num_rows': num_rows,
+                'columns': columns, 'nbytes': total_nbytes, 'original_nbytes': original_nbytes}
+    _write_manifest(tmp_dir, manifest)
+
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+    return manifest
+
+
+def _is_text(column):
+    return column.dtype == object or isinstance(column.dtype, pd.CategoricalDtype)
+
+
+def _category_codes(name, column, known):
+    # Codes of the values of column, adding new categories to known
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+    elif column.dtype == object or column.isna().all():
+        # A chunk without any text in a text column is parsed as float NaN
+        codes, uniques = pd.factorize(column)
+    else:
+        raise MixedColumnTypes('Column ' + name + ' mixes text and numbers')
+    lookup = np.empty(len(uniques) + 1, dtype=np.int64)
+    for i, value in enumerate(uniques):
+        lookup[i] = known.setdefault(value, len(known))
+    # Missing values keep code -1
+    lookup[-1] = -1
+    return lookup[codes]
+
+
+def _sorted_categories(known):
+    # Categories sorted like pd.Categorical sorts them, with the mapping from the order of appearance
+    categories = pd.Index(list(known))
+    try:
+        order = categories.argsort()
+    except TypeError:
+        order = np.arange(len(categories))
+    remap = np.empty(len(categories) + 1, dtype=np.int64)
+    remap[order] = np.arange(len(categories))
+    remap[-1] = -1
+    return categories[order].tolist(), remap
+
+
+def _common_dtype(dtypes):
+    # Integer chunks of a column with missing values elsewhere become float, of the width the other chunks have
+    floats = [dtype for dtype in dtypes if dtype.kind == 'f']
+    if floats:
+        return np.result_type(*floats)
+    return np.result_type(*dtypes)
+
+
+def _join_parts(parts, path, dtype, num_rows, remap=None):
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_rows,))
+    start = 0
+    for part in parts:
+        values = np.load(part, allow_pickle=False)
+        if remap is not None:
+            values = remap[values]
+        out[start:start + len(values)] = values
+        start += len(values)
+        os.remove(part)
+    out.flush()
+    del out
+
+
+class ColumnStore:
+    """
+    Column-at-a-time access to a cached feature table. A column is read from its
+    memory-mapped file on first use and kept in memory while it is among the
+    recently used ones (up to hot_bytes); pinned columns stay resident. A store
+    wrapping an in-memory DataFrame (when no cache could be written) keeps every
+    column resident. The row index is exposed as the 'id' column. source is the
+    fingerprint of the CSV the cache was built from, with its content hash.
+    """
+
+    def __init__(self, num_rows, cache_dir=None, manifest=None, frame=None, hot_bytes=0, pinned=()):
+        self.num_rows = num_rows
+        self.source = manifest['source'] if manifest is not None else None
+        self._cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self._frame = frame
+        if frame is not None:
+            self._entries = {name: None for name in frame.columns if name != 'id'}
+            pinned = list(self._entries)
+        else:
+            self._entries = {entry['name']: entry for entry in manifest['columns'] if entry['name'] != 'id'}
+        self.columns = list(self._entries) + ['id']
+        self._hot = LRUCache(hot_bytes)
+        compact = manifest is not None and manifest['options'].get('compact', False)
+        # With compact dtypes the row index is stored as uint32 like the ID column
+        self._pinned = {'id': np.arange(num_rows, dtype=np.uint32 if compact else np.int64)}
+        for name in pinned:
+            if name in self._entries:
+                self._pinned[name] = self._read(name)
+        for values in self._pinned.values():
+            _set_read_only(values)
+        self._pinned_bytes = sum(_nbytes(values) for values in self._pinned.values())
+
+    def __contains__(self, name):
+        return name in self._pinned or name in self._entries
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        values = self._resident(name)
+        if values is None:
+            values = self._read(name)
+            _set_read_only(values)
+            self._hot.put(name, values, _nbytes(values))
+        return values
+
+    def frame(self, columns=None, copy=False):
+        # Without copy the frame shares (read-only) arrays with the store
+        if columns is None:
+            columns = self.columns
+        columns = list(dict.fromkeys(columns))
+        if copy:
+            data = {name: self._resident(name).copy() if self._resident(name) is not None else self._read(name)
+                    for name in columns}
+        else:
+            data = {name: self.column(name) for name in columns}
+        return pd.DataFrame(data, columns=columns, copy=False)
+
+    def rows(self, index, columns=None):
+        # Reads only the requested rows of columns that are not resident
+        if columns is None:
+            columns = self.columns
+        columns = list(dict.fromkeys(columns))
+        index = np.asarray(index, dtype=np.intp)
+        data = {}
+        for name in columns:
+            values = self._resident(name)
+            if values is None:
+                values = self._read(name, index)
+            else:
+                values = values[index]
+            data[name] = values
+        return pd.DataFrame(data, columns=columns, index=index, copy=False)
+
+    def resident_bytes(self):
+        return self._pinned_bytes + self._hot.total_bytes
+
+    def _resident(self, name):
+        values = self._pinned.get(name)
+        if values is None:
+            values = self._hot.get(name)
+        return values
+
+    def _read(self, name, index=None):
+        if self._frame is not None:
+            values = self._frame[name].to_numpy()
+            return values if index is None else values[index]
+        entry = self._entries[name]
+        values = np.load(self._cache_dir / entry['file'], mmap_mode='r', allow_pickle=False)
+        values = values[index] if index is not None else np.array(values)
+        if entry['kind'] == 'categorical':
+            values = pd.Categorical.from_codes(values, entry['categories'])
+            if entry['as_object']:
+                values = np.asarray(values.astype(object))
+        return values
+
+
+def _set_read_only(values):
+    if isinstance(values, np.ndarray):
+        values.flags.writeable = False
+
+
+def _nbytes(values):
+    if isinstance(values, pd.Categorical):
+        return values.nbytes
+    if values.dtype == object:
+        return int(pd.Series(values, copy=False).memory_usage(index=False, deep=True))
+    return values.nbytes
+
+
+def load(csv_path, cache_dir, prepare=None, options=None, hot_bytes=0, pinned=(), chunk_rows=CHUNK_ROWS,
+         progress=None):
+    """
+    Returns a ColumnStore over the feature table stored at csv_path, backed by the
+    column cache in cache_dir when it is current and was built with the same
+    options. Otherwise the CSV is converted chunk_rows rows at a time, prepare
+    being applied to each chunk, and the result is cached before being reopened.
+    """
+    manifest = is_valid(cache_dir, csv_path, options)
+    if manifest is None:
+        print("Loading csv data.. (this can take some time)")
+        try:
+            try:
+                manifest = write_chunks(read_chunks(csv_path, chunk_rows, prepare, progress), cache_dir, csv_path,
+                                        options)
+            except MixedColumnTypes as e:
+                # pandas only settles on a type for such columns when it reads the whole table
+                print(e, "- reading", csv_path, "in one piece")
+                manifest = write(_read_whole(csv_path, prepare), cache_dir, csv_path, options)
+        except (OSError, TypeError, ValueError) as e:
+            print("Could not write column cache:", e)
+            df = _read_whole(csv_path, prepare)
+            return ColumnStore(len(df), frame=df)
+    if manifest['options'].get('compact', False):
+        print("Opening cached columns from", cache_dir, "(%.1f MB, %.1f MB before compaction)"
+              % (manifest['nbytes'] / 1024 ** 2, manifest['original_nbytes'] / 1024 ** 2))
+    else:
+        print("Opening cached columns from", cache_dir, "(%.1f MB)" % (manifest['nbytes'] / 1024 ** 2))
+    return ColumnStore(manifest['num_rows'], cache_dir=cache_dir, manifest=manifest, hot_bytes=hot_bytes,
+                       pinned=pinned)
+
+
+def _read_whole(csv_path, prepare=None):
+    df = pd.read_csv(csv_path)
+    if prepare is not None:
+        df = prepare(df)
+    return df
+
+
+def _write_manifest(cache_dir, manifest):
+    tmp_path = Path(cache_dir) / (MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, Path(cache_dir) / MANIFEST_NAME)
@@ -0,0 +1,183 @@
+# Summed-area tables of cell counts over the spatial index grid.
+#
+# The number of cells in any block of grid bins is read from a summed-area
+# table with four lookups. Rectangles and circles are counted either
+# approximately, assuming cells are spread evenly within a bin, or exactly, by
+# adding the bins inside the shape from the table and testing only the cells of
+# the bins its boundary crosses. Coarser levels (bins merged 2 x 2) keep
+# approximate counts of large shapes to a few dozen lookups.
+import math
+
+import numpy as np
+
+from minerva_analysis.server.utils.spatial_index import ranges
+
+# Bins across a shape approximate counts are read at
+APPROX_BINS = 32
+
+
+class DensityTable:
+    """
+    Counts of the cells of a SpatialIndex, or of those selected by mask (a
+    boolean array over table rows), in rectangles and circles.
+    """
+
+    def __init__(self, index, mask=None):
+        self.index = index
+        counts = np.diff(index.offsets)
+        self.selected = None
+        if mask is not None:
+            # Whether the cell at each position of the index is counted
+            self.selected = np.asarray(mask, dtype=bool)[index.order]
+            bins = np.repeat(np.arange(len(counts)), counts)
+            counts = np.bincount(bins[self.selected], minlength=len(counts))
+        counts = counts.reshape(index.ny, index.nx)
+        self.levels = [_summed_area(counts)]
+        while counts.shape[0] > 1 or counts.shape[1] > 1:
+            counts = _merge(counts)
+            self.levels.append(_summed_area(counts))
+
+    def resident_bytes(self):
+        selected = self.selected.nbytes if self.selected is not None else 0
+        return sum(table.nbytes for table in self.levels) + selected
+
+    def count_rect(self, x0, y0, x1, y1, exact=False):
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        if not exact:
+            level = self._level(max(x1 - x0, y1 - y0))
+            return float(self._cumulative(level, x1, y1) - self._cumulative(level, x0, y1) -
+                         self._cumulative(level, x1, y0) + self._cumulative(level, x0, y0))
+
+        index = self.index
+        size = index.bin_size
+        rows = self._rows(y0, y1)
+        outer0 = np.full(len(rows), math.floor((x0 - index.origin[0]) / size))
+        outer1 = np.full(len(rows), math.floor((x1 - index.origin[0]) / size))
+        # Bins entirely inside the rectangle
+        inner_x0 = math.ceil((x0 - index.origin[0]) / size)
+        inner_x1 = math.floor((x1 - index.origin[0]) / size) - 1
+        bottom = index.origin[1] + rows * size
+        inner_row = (bottom >= y0) & (bottom + size <= y1)
+        inner0 = np.where(inner_row, inner_x0, 1)
+        inner1 = np.where(inner_row, inner_x1, 0)
+
+        def contains(points):
+            return (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+
+        return self._exact(rows, outer0, outer1, inner0, inner1, contains)
+
+    def count_circle(self, x, y, r, exact=False):
+        if r < 0:
+            return 0
+        if not exact:
+            # Horizontal slabs of the circle, each counted as a rectangle as wide
+            # as the circle is at the middle of the slab
+            level = self._level(2 * r)
+            slabs = max(math.ceil(2 * r / (self.index.bin_size * 2 ** level)), 8)
+            edges = y - r + 2 * r * np.arange(slabs + 1) / slabs
+            middles = (edges[:-1] + edges[1:]) / 2
+            half = np.sqrt(np.maximum(r * r - (middles - y) ** 2, 0))
+            counts = (self._cumulative(level, x + half, edges[1:]) - self._cumulative(level, x - half, edges[1:]) -
+                      self._cumulative(level, x + half, edges[:-1]) + self._cumulative(level, x - half, edges[:-1]))
+            return float(counts.sum())
+
+        index = self.index
+        size = index.bin_size
+        rows = self._rows(y - r, y + r)
+        bottom = index.origin[1] + rows * size
+        # Closest and farthest vertical distance from y to each row of bins
+        near = np.maximum(np.maximum(bottom - y, y - (bottom + size)), 0)
+        far = np.maximum(np.abs(bottom - y), np.abs(bottom + size - y))
+        outer = np.sqrt(np.maximum(r * r - near ** 2, 0))
+        inner = np.sqrt(np.maximum(r * r - far ** 2, 0))
+        outer0 = np.floor((x - outer - index.origin[0]) / size).astype(np.int64)
+        outer1 = np.floor((x + outer - index.origin[0]) / size).astype(np.int64)
+        inner0 = np.ceil((x - inner - index.origin[0]) / size).astype(np.int64)
+        inner1 = np.floor((x + inner - index.origin[0]) / size).astype(np.int64) - 1
+        inner1 = np.where(far <= r, inner1, inner0 - 1)
+
+        def contains(points):
+            return (points[:, 0] - x) ** 2 + (points[:, 1] - y) ** 2 <= r * r
+
+        return self._exact(rows, outer0, outer1, inner0, inner1, contains)
+
+    def _level(self, extent):
+        # Coarsest level with at least APPROX_BINS bins across extent
+        bins = extent / (self.index.bin_size * APPROX_BINS)
+        level = int(math.floor(math.log2(bins))) if bins >= 1 else 0
+        return min(level, len(self.levels) - 1)
+
+    def _cumulative(self, level, x, y):
+        # Cells left of x and below y, assuming cells are spread evenly within a bin
+        table = self.levels[level]
+        ny, nx = table.shape[0] - 1, table.shape[1] - 1
+        size = self.index.bin_size * 2 ** level
+        fx = np.clip((np.asarray(x, dtype=np.float64) - self.index.origin[0]) / size, 0, nx)
+        fy = np.clip((np.asarray(y, dtype=np.float64) - self.index.origin[1]) / size, 0, ny)
+        ix = np.minimum(np.floor(fx).astype(np.int64), nx - 1)
+        iy = np.minimum(np.floor(fy).astype(np.int64), ny - 1)
+        tx = fx - ix
+        ty = fy - iy
+        return (table[iy, ix] * (1 - tx) * (1 - ty) + table[iy, ix + 1] * tx * (1 - ty) +
+                table[iy + 1, ix] * (1 - tx) * ty + table[iy + 1, ix + 1] * tx * ty)
+
+    def _rows(self, y0, y1):
+        # Rows of bins [y0, y1] overlaps
+        index = self.index
+        by0 = max(math.floor((y0 - index.origin[1]) / index.bin_size), 0)
+        by1 = min(math.floor((y1 - index.origin[1]) / index.bin_size), index.ny - 1)
+        return np.arange(by0, by1 + 1, dtype=np.int64)
+
+    def _exact(self, rows, outer0, outer1, inner0, inner1, contains):
+        # The shape overlaps bins outer0..outer1 of each row and covers bins
+        # inner0..inner1 entirely: those are read from the table, the cells of
+        # the others are tested with contains
+        index = self.index
+        if len(rows) == 0 or len(index) == 0:
+            return 0
+        outer0 = np.clip(outer0, 0, index.nx - 1)
+        outer1 = np.clip(outer1, 0, index.nx - 1)
+        inner0 = np.maximum(inner0, outer0)
+        inner1 = np.minimum(inner1, outer1)
+        count = _block_sums(self.levels[0], inner0, rows, inner1, rows).sum()
+
+        empty = inner0 > inner1
+        inner0 = np.where(empty, outer1 + 1, inner0)
+        inner1 = np.where(empty, outer1, inner1)
+        segment_rows = np.concatenate([rows, rows])
+        segment_starts = np.concatenate([outer0, inner1 + 1])
+        segment_stops = np.concatenate([np.minimum(inner0 - 1, outer1), outer1])
+        valid = segment_starts <= segment_stops
+        first = index.offsets[segment_rows[valid] * index.nx + segment_starts[valid]]
+        last = index.offsets[segment_rows[valid] * index.nx + segment_stops[valid] + 1]
+        positions = ranges(first, last)
+        inside = contains(index.points[positions])
+        if self.selected is not None:
+            inside &= self.selected[positions]
+        return int(count + inside.sum())
+
+
+def _summed_area(counts):
+    table = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(counts, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+
+def _merge(counts):
+    # Sums 2 x 2 blocks of bins, padding odd sizes with empty bins
+    ny, nx = counts.shape
+    padded = np.zeros((ny + ny % 2, nx + nx % 2), dtype=counts.dtype)
+    padded[:ny, :nx] = counts
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).sum(axis=(1, 3))
+
+
+def _block_sums(table, bx0, by0, bx1, by1):
+    # Cells in bins [bx0, bx1] x [by0, by1], 0 for empty ranges
+    ny, nx = table.shape[0] - 1, table.shape[1] - 1
+    x0 = np.clip(bx0, 0, nx)
+    x1 = np.clip(np.asarray(bx1) + 1, 0, nx)
+    y0 = np.clip(by0, 0, ny)
+    y1 = np.clip(np.asarray(by1) + 1, 0, ny)
+    sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return np.where((x1 > x0) & (y1 > y0), sums, 0)
@@ -0,0 +1,88 @@
+# Fingerprints of the inputs derived artifacts are built from.
+#
+# An artifact (spatial index, color scheme, overview, statistics, ...) records
+# the files and columns it was built from, with the parameters used, in a
+# sidecar file next to it. It is reused as long as the fingerprint of its
+# current inputs matches, and rebuilt when it doesn't.
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def file_hash(path, chunk_size=1 << 24):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def of_file(path, content_hash=None):
+    stat = os.stat(path)
+    fingerprint = {'path': str(Path(path).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if content_hash is not None:
+        fingerprint['hash'] = content_hash
+    return fingerprint
+
+
+def describe(files, columns=(), **params):
+    """
+    Fingerprint of inputs: files are paths, or fingerprints from of_file when the
+    content hash is already known; columns are the table columns used and params
+    any other (JSON serializable) settings the artifact depends on.
+    """
+    return {'files': [f if isinstance(f, dict) else of_file(f) for f in files], 'columns': list(columns),
+            'params': json.loads(json.dumps(params))}
+
+
+def sidecar_path(artifact_path):
+    return Path(str(artifact_path) + '.fingerprint.json')
+
+
+def write(artifact_path, inputs):
+    # Called once the artifact is written, the artifact's own size and mtime are recorded as well
+    record = {'inputs': inputs, 'artifact': of_file(artifact_path)}
+    path = sidecar_path(artifact_path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+
+def is_current(artifact_path, inputs):
+    """
+    Whether the artifact at artifact_path was built from inputs (from describe).
+    An input file whose size matches but mtime doesn't (e.g. it was copied or
+    touched) is compared by content hash when one was recorded.
+    """
+    try:
+        with open(sidecar_path(artifact_path), 'r') as f:
+            record = json.load(f)
+        artifact = of_file(artifact_path)
+    except (OSError, ValueError):
+        return False
+    # The artifact was rewritten after its fingerprint was, e.g. interrupted by a crash
+    if (artifact['size'], artifact['mtime_ns']) != (record['artifact']['size'], record['artifact']['mtime_ns']):
+        return False
+    recorded = record['inputs']
+    if recorded['columns'] != inputs['columns'] or recorded['params'] != inputs['params']:
+        return False
+    if len(recorded['files']) != len(inputs['files']):
+        return False
+    touched = False
+    for old, new in zip(recorded['files'], inputs['files']):
+        if old['path'] != new['path'] or old['size'] != new['size']:
+            return False
+        if old['mtime_ns'] != new['mtime_ns']:
+            if 'hash' not in old:
+                return False
+            if new.get('hash') is None:
+                new['hash'] = file_hash(new['path'])
+            if old['hash'] != new['hash']:
+                return False
+            touched = True
+    if touched:
+        # Record the new mtimes so the files are not hashed again
+        write(artifact_path, inputs)
+    return True
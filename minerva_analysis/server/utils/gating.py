@@ -0,0 +1,262 @@
+# Evaluates gates on the columns of a feature table.
+#
+# A gate keeps the cells whose value of a channel lies strictly between its
+# bounds, like the "lo < `channel` < hi" clauses that used to be built for
+# DataFrame.query. Gates are evaluated on the column arrays into boolean masks
+# over rows and combined with & (cells in all gates) or | (in any gate).
+#
+# Gates selecting few cells are answered from sorted channel indexes instead:
+# the rows of the most selective gate are read from its index, then checked
+# against the other gates (all gates), or the rows of every gate are merged
+# (any gate).
+#
+# Gating trees define populations hierarchically: every node holds the cells
+# of its parent population (all cells for nodes without a parent) that lie in
+# its own range gates and polygon gates, {'x': channel, 'y': channel,
+# 'points': [[x, y], ...]} in the plot of two channels. A node's mask is cached
+# under the definition of its whole branch, so when a node is edited only its
+# subtree is evaluated again.
+import numpy as np
+
+from minerva_analysis.server.utils.cellset import CellSet
+
+# Sorted indexes are used while the rows they return are fewer than this
+# fraction of the rows a scan reads (the table's, once per gate)
+INDEX_MAX_FRACTION = 0.05
+
+
+def range_mask(values, lo, hi):
+    # Missing values are in no gate
+    values = np.asarray(values)
+    return (values > lo) & (values < hi)
+
+
+def gates_mask(table, gates, combine='and', cache=None, session=''):
+    """
+    Mask of the rows of table in all (combine='and') or any (combine='or') of
+    gates, a dict of channel: [lo, hi]. None without gates.
+
+    With a cache (an LRUCache) the mask of every gate and of every combination
+    evaluated is kept, read-only. As most changes move one gate of the set a
+    session evaluated last, the other gates' combined mask is cached as well,
+    so while a gate is dragged only that gate is evaluated again.
+    """
+    if not gates:
+        return None
+    if cache is None:
+        return _combine([range_mask(table.column(channel), bounds[0], bounds[1])
+                         for channel, bounds in gates.items()], combine)
+
+    predicates = {_predicate(channel, bounds): (channel, bounds) for channel, bounds in gates.items()}
+    key = (combine, frozenset(predicates))
+    mask = cache.get(key)
+    if mask is None:
+        last = cache.get(('last', session, combine))
+        changed = set(predicates) - last if last is not None else None
+        if changed is not None and len(changed) == 1 and len(predicates) > 1:
+            rest = frozenset(predicates) - changed
+            rest_mask = cache.get((combine, rest))
+            if rest_mask is None:
+                rest_mask = _cached(cache, (combine, rest), _combine(
+                    [_gate_mask(table, predicates[p][0], predicates[p][1], cache) for p in rest], combine))
+            changed = changed.pop()
+            masks = [rest_mask, _gate_mask(table, predicates[changed][0], predicates[changed][1], cache)]
+        else:
+            masks = [_gate_mask(table, channel, bounds, cache) for channel, bounds in predicates.values()]
+        mask = _cached(cache, key, _combine(masks, combine))
+    cache.put(('last', session, combine), frozenset(predicates), 0)
+    return mask
+
+
+def gates_rows(table, gates, combine='and', indexes=None, cache=None, session=''):
+    """
+    Rows of table in all (combine='and') or any (combine='or') of gates, in
+    increasing order, None without gates. indexes maps channels to their
+    SortedIndex where one is available, these are used instead of scanning the
+    columns when the gates are selective enough. Otherwise the masks are
+    evaluated with cache as in gates_mask.
+    """
+    if not gates:
+        return None
+    indexes = indexes or {}
+    counts = {channel: indexes[channel].count(bounds[0], bounds[1]) for channel, bounds in gates.items()
+              if channel in indexes}
+    budget = len(table) * len(gates) * INDEX_MAX_FRACTION
+    if combine == 'and' and counts and min(counts.values()) <= budget:
+        channel = min(counts, key=counts.get)
+        rows = np.sort(indexes[channel].range_rows(gates[channel][0], gates[channel][1])).astype(np.intp)
+        for other, bounds in gates.items():
+            if other != channel and len(rows) > 0:
+                rows = rows[range_mask(table.rows(rows, [other])[other].to_numpy(), bounds[0], bounds[1])]
+        return rows
+    if combine != 'and' and len(counts) == len(gates) and sum(counts.values()) <= budget:
+        return np.unique(np.concatenate([indexes[channel].range_rows(bounds[0], bounds[1])
+                                         for channel, bounds in gates.items()])).astype(np.intp)
+    return np.flatnonzero(gates_mask(table, gates, combine, cache, session))
+
+
+def gates_count(table, gates, combine='and', indexes=None, cache=None, session=''):
+    # Number of rows of table in the gates, as gates_rows but 0 without gates; a single gate with an index is
+    # counted from it
+    if not gates:
+        return 0
+    indexes = indexes or {}
+    if len(gates) == 1:
+        channel, bounds = next(iter(gates.items()))
+        if channel in indexes:
+            return indexes[channel].count(bounds[0], bounds[1])
+    return len(gates_rows(table, gates, combine, indexes, cache, session))
+
+
+def gate_sets_masks(table, gate_sets, combine='and', cache=None):
+    """
+    Masks of many named gate sets (name: gates) at once. Each distinct gate is
+    evaluated once, each column read once, and shared by the sets using it.
+    Sets without gates get None.
+    """
+    if cache is None:
+        cache = {}
+    masks = {}
+    for name, gates in gate_sets.items():
+        gate_masks = [_gate_mask(table, channel, bounds, cache) for channel, bounds in gates.items()]
+        masks[name] = _combine(gate_masks, combine) if gate_masks else None
+    return masks
+
+
+def exclusive_labels(masks, num_rows):
+    """
+    For every row the position in masks (a list, by priority) of the first mask
+    holding it, -1 for rows in none, so each cell gets at most one label.
+    """
+    labels = np.full(num_rows, -1, dtype='<i2' if len(masks) < 2 ** 15 else '<i4')
+    for label, mask in reversed(list(enumerate(masks))):
+        if mask is not None:
+            labels[mask] = label
+    return labels
+
+
+def polygon_mask(x, y, points):
+    # Whether each point (x, y) lies in the polygon, by the even-odd rule; missing values are outside
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros(len(x), dtype=bool)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return inside
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (x0, y0), (x1, y1) in zip(points, np.roll(points, -1, axis=0)):
+            crosses = (y0 > y) != (y1 > y)
+            inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+
+def tree_order(nodes):
+    """
+    The nodes of a gating tree (dicts with an id, the id of their parent or
+    None, gates and polygons) with every parent before its children. Raises
+    ValueError for repeated ids, unknown parents and cycles.
+    """
+    ids = [node['id'] for node in nodes]
+    if len(set(ids)) != len(ids):
+        raise ValueError('Node ids must be unique')
+    ordered, placed, pending = [], set(), list(nodes)
+    while pending:
+        ready = [node for node in pending if node.get('parent') is None or node['parent'] in placed]
+        if not ready:
+            raise ValueError('Nodes with unknown parents or in a cycle: ' +
+                             ', '.join(str(node['id']) for node in pending))
+        ordered += ready
+        placed.update(node['id'] for node in ready)
+        pending = [node for node in pending if node['id'] not in placed]
+    return ordered
+
+
+def tree_masks(table, nodes, cache=None):
+    # Mask of the population of every node of a gating tree, by id, see tree_order
+    if cache is None:
+        cache = {}
+    masks, keys = {}, {}
+    for node in tree_order(nodes):
+        parent = node.get('parent')
+        own_key = _node_key(node)
+        if parent is not None and own_key == (frozenset(), frozenset()):
+            # Without gates of its own a node is its parent's population
+            masks[node['id']], keys[node['id']] = masks[parent], keys[parent]
+            continue
+        key = ('node', keys.get(parent), own_key)
+        mask = cache.get(key)
+        if mask is None:
+            mask = _cached(cache, key, _node_mask(table, node, masks.get(parent), cache))
+        masks[node['id']], keys[node['id']] = mask, key
+    return masks
+
+
+def _node_key(node):
+    gates = frozenset(_predicate(channel, bounds) for channel, bounds in (node.get('gates') or {}).items())
+    polygons = frozenset((polygon['x'], polygon['y'], tuple(tuple(float(v) for v in point)
+                                                            for point in polygon['points']))
+                         for polygon in node.get('polygons') or [])
+    return gates, polygons
+
+
+def _node_mask(table, node, parent_mask, cache):
+    masks = [_gate_mask(table, channel, bounds, cache) for channel, bounds in (node.get('gates') or {}).items()]
+    if parent_mask is not None:
+        masks.append(parent_mask)
+    mask = _combine(masks, 'and') if masks else np.ones(len(table), dtype=bool)
+    # Polygons are tested on the cells still in the population only
+    for polygon in node.get('polygons') or []:
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            break
+        values = table.rows(rows, [polygon['x'], polygon['y']])
+        inside = polygon_mask(values[polygon['x']].to_numpy(), values[polygon['y']].to_numpy(), polygon['points'])
+        mask[rows[~inside]] = False
+    return mask
+
+
+def _predicate(channel, bounds):
+    return channel, float(bounds[0]), float(bounds[1])
+
+
+def _gate_mask(table, channel, bounds, cache):
+    # cache is an LRUCache or a dict
+    key = ('gate',) + _predicate(channel, bounds)
+    mask = cache.get(key)
+    if mask is None:
+        mask = _cached(cache, key, range_mask(table.column(channel), bounds[0], bounds[1]))
+    return mask
+
+
+def _cached(cache, key, mask):
+    mask.flags.writeable = False
+    if isinstance(cache, dict):
+        cache[key] = mask
+        return mask
+    return cache.put(key, mask, mask.nbytes)
+
+
+def _combine(masks, combine):
+    # A new mask, the masks are not modified
+    mask = masks[0].copy()
+    for other in masks[1:]:
+        if combine == 'and':
+            mask &= other
+        else:
+            mask |= other
+    return mask
+
+
+def encode_rows(rows, num_rows, encoding='ids', ids=None):
+    """
+    Binary payload of rows (of a table of num_rows): 'ids' packs them, or ids
+    (their values of an ID column) if given, as uint32, 'bitset' sets one bit
+    per row, least significant bit first, and 'cellset' encodes a CellSet.
+    """
+    if encoding == 'cellset':
+        return CellSet.from_rows(rows).to_bytes()
+    if encoding == 'bitset':
+        mask = np.zeros(num_rows, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask, bitorder='little').tobytes()
+    return np.asarray(rows if ids is None else ids).astype(np.uint32).tobytes()
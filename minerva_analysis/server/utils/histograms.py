@@ -0,0 +1,92 @@
+# Cumulative histograms of channel columns, for instant gate counts.
+#
+# Every numeric column gets HISTOGRAM_BINS equal bins between its smallest and
+# largest value, stored as the number of values below each bin edge. The
+# number of cells in a gate is read from these, interpolating within the bins
+# the bounds fall in, without touching the column. Gates on several channels
+# are estimated assuming the channels are independent. On disk all columns are
+# one .npz file:
+#   columns      column names
+#   edges        bin edges, one row per column
+#   cumulative   number of values below each edge (the last edge: all values)
+#   num_rows     number of rows of the table, counting missing values
+from pathlib import Path
+
+import numpy as np
+
+HISTOGRAM_BINS = 4096
+
+
+class CumulativeHistograms:
+    def __init__(self, columns, edges, cumulative, num_rows):
+        self.columns = list(columns)
+        self.edges = edges
+        self.cumulative = cumulative
+        self.num_rows = num_rows
+        self._positions = {column: i for i, column in enumerate(self.columns)}
+
+    def __contains__(self, column):
+        return column in self._positions
+
+    def resident_bytes(self):
+        return self.edges.nbytes + self.cumulative.nbytes
+
+    def count(self, column, lo, hi):
+        # Estimated number of rows with lo < value < hi
+        i = self._positions[column]
+        below = np.interp([lo, hi], self.edges[i], self.cumulative[i])
+        return max(float(below[1] - below[0]), 0.0)
+
+    def estimate(self, gates, combine='and'):
+        """
+        Estimated number of rows in all (combine='and') or any (combine='or')
+        of gates, a dict of channel: [lo, hi], the channels taken as
+        independent. All rows without gates.
+        """
+        if not gates:
+            return self.num_rows
+        if self.num_rows == 0:
+            return 0
+        fractions = np.array([self.count(channel, bounds[0], bounds[1]) / self.num_rows
+                              for channel, bounds in gates.items()])
+        if combine == 'and':
+            fraction = np.prod(fractions)
+        else:
+            fraction = 1 - np.prod(1 - fractions)
+        return int(round(fraction * self.num_rows))
+
+
+def build(columns, num_rows, path):
+    # Builds the histograms of columns, (name, values) pairs, and writes them to path
+    names, edges, cumulative = [], [], []
+    for name, values in columns:
+        values = np.asarray(values)
+        values = values[np.isfinite(values)] if np.issubdtype(values.dtype, np.floating) else values
+        value_range = (values.min(), values.max()) if len(values) > 0 else (0, 1)
+        counts, column_edges = np.histogram(values, bins=HISTOGRAM_BINS, range=value_range)
+        names.append(name)
+        edges.append(column_edges.astype(np.float64))
+        cumulative.append(np.concatenate(([0], np.cumsum(counts))))
+    edges = np.array(edges, dtype=np.float64).reshape(len(names), HISTOGRAM_BINS + 1)
+    cumulative = np.array(cumulative, dtype=np.int64).reshape(len(names), HISTOGRAM_BINS + 1)
+
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, columns=np.array(names, dtype=str), edges=edges, cumulative=cumulative,
+                 num_rows=np.int64(num_rows))
+    tmp_path.replace(path)
+    return CumulativeHistograms(names, edges, cumulative, num_rows)
+
+
+def load(path):
+    # Returns the histograms stored at path, None if there are no usable ones
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            histograms = CumulativeHistograms(data['columns'].tolist(), data['edges'], data['cumulative'],
+                                              int(data['num_rows']))
+    except (OSError, ValueError, KeyError):
+        return None
+    if histograms.edges.shape != (len(histograms.columns), HISTOGRAM_BINS + 1):
+        return None
+    return histograms
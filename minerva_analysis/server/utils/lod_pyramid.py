@@ -0,0 +1,221 @@
+# Multi-resolution pyramid of cell centroids, for drawing zoomed-out views.
+#
+# Level L of the pyramid parallels level L of the image pyramid: the image is
+# divided into square bins of BIN_PIXELS screen pixels at that level, i.e.
+# BIN_PIXELS * 2 ** L image pixels, aligned with the image tiles. Cells are
+# stored sorted by the Z-order (Morton) code of their finest bin, so the cells
+# of any bin at any level are one contiguous range. For every non-empty bin of
+# every level the pyramid holds its cell count, mean centroid, the cell
+# closest to its centre (a spatially stratified sample) and its most common
+# phenotype. On disk these are .npy files memory-mapped when opened:
+#   order.npy              table rows in Z-order
+#   bin_x.npy, bin_y.npy   bin coordinates, levels one after the other
+#   start.npy, count.npy   range of the bin's cells in order
+#   sample.npy             table row of the cell closest to the bin centre
+#   mean_x.npy, mean_y.npy mean centroid of the bin's cells
+#   phenotype.npy          index in meta['phenotypes'] of the most common one, -1 for none
+#   meta.json              bin size, levels (range of their bins) and phenotypes
+import json
+import math
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from minerva_analysis.server.utils.spatial_index import ranges
+
+PYRAMID_VERSION = 1
+META_NAME = 'meta.json'
+# Size of a bin in screen pixels at every level
+BIN_PIXELS = 8
+FIELDS = ['bin_x', 'bin_y', 'start', 'count', 'sample', 'mean_x', 'mean_y', 'phenotype']
+
+
+class CentroidPyramid:
+    def __init__(self, order, bins, meta):
+        self.order = order
+        self.bins = bins
+        self.meta = meta
+        self.levels = meta['levels']
+        self.phenotypes = meta['phenotypes']
+
+    def __len__(self):
+        return len(self.order)
+
+    def resident_bytes(self):
+        # Memory-mapped arrays are paged in and out by the OS and are not counted
+        arrays = [self.order] + list(self.bins.values())
+        return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+
+    def bin_size(self, level):
+        return BIN_PIXELS * 2 ** level
+
+    def select(self, level, x0=None, y0=None, x1=None, y1=None):
+        """
+        Positions in the bin arrays of the non-empty bins of level (clamped to the
+        pyramid's levels) overlapping the viewport, all of them without one.
+        """
+        level = min(max(level, 0), len(self.levels) - 1)
+        start, stop = self.levels[level]
+        if x0 is None:
+            return np.arange(start, stop)
+        size = self.bin_size(level)
+        bin_x = self.bins['bin_x'][start:stop]
+        bin_y = self.bins['bin_y'][start:stop]
+        inside = ((bin_x >= math.floor(min(x0, x1) / size)) & (bin_x <= math.floor(max(x0, x1) / size)) &
+                  (bin_y >= math.floor(min(y0, y1) / size)) & (bin_y <= math.floor(max(y0, y1) / size)))
+        return start + np.flatnonzero(inside)
+
+    def means(self, selected, values):
+        # Mean of values (one per table row) over the cells of each selected bin
+        counts = np.asarray(self.bins['count'][selected], dtype=np.int64)
+        if len(selected) == 0:
+            return np.empty(0, dtype=np.float64)
+        starts = np.asarray(self.bins['start'][selected], dtype=np.int64)
+        positions = ranges(starts, starts + counts)
+        sums = np.add.reduceat(np.asarray(values, dtype=np.float64)[self.order[positions]],
+                               np.cumsum(counts) - counts)
+        return sums / counts
+
+
+def build(x, y, pyramid_dir, phenotypes=None, meta=None):
+    """
+    Builds the pyramid over the cells at (x, y) in image pixels, with their
+    phenotypes if given, and writes it to pyramid_dir. meta is stored along with
+    the description of the levels.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    x, y = np.maximum(x[rows], 0), np.maximum(y[rows], 0)
+    if phenotypes is not None:
+        codes, names = pd.factorize(np.asarray(phenotypes)[rows], sort=True)
+        names = [str(name) for name in names]
+    else:
+        codes, names = np.full(len(rows), -1), []
+
+    bx = (x // BIN_PIXELS).astype(np.uint64)
+    by = (y // BIN_PIXELS).astype(np.uint64)
+    extent = int(max(bx.max(), by.max())) + 1 if len(rows) > 0 else 1
+    # Levels up to the one where all cells fall in a single bin
+    num_levels = max(math.ceil(math.log2(extent)), 0) + 1
+    sort = np.argsort(_morton(bx, by), kind='stable')
+    rows, x, y, bx, by, codes = rows[sort], x[sort], y[sort], bx[sort], by[sort], codes[sort]
+    code = _morton(bx, by)
+
+    levels = []
+    bins = {field: [] for field in FIELDS}
+    num_bins = 0
+    for level in range(num_levels):
+        keys = code >> np.uint64(2 * level)
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) > 0 else \
+            np.empty(0, dtype=np.int64)
+        counts = np.diff(np.append(starts, len(keys)))
+        size = BIN_PIXELS * 2 ** level
+        bin_x = (bx[starts] >> np.uint64(level)).astype(np.int32)
+        bin_y = (by[starts] >> np.uint64(level)).astype(np.int32)
+        # The cell closest to the bin centre
+        centre_x = np.repeat((bin_x + 0.5) * size, counts)
+        centre_y = np.repeat((bin_y + 0.5) * size, counts)
+        distance = (x - centre_x) ** 2 + (y - centre_y) ** 2
+        samples = _first_minimum(distance, starts, counts)
+        bins['bin_x'].append(bin_x)
+        bins['bin_y'].append(bin_y)
+        bins['start'].append(starts.astype(np.int64))
+        bins['count'].append(counts.astype(np.int32))
+        bins['sample'].append(rows[samples].astype(np.int64))
+        bins['mean_x'].append((np.add.reduceat(x, starts) / counts).astype(np.float32) if len(starts) else
+                              np.empty(0, dtype=np.float32))
+        bins['mean_y'].append((np.add.reduceat(y, starts) / counts).astype(np.float32) if len(starts) else
+                              np.empty(0, dtype=np.float32))
+        bins['phenotype'].append(_most_common(codes, starts, counts, len(names)))
+        levels.append([num_bins, num_bins + len(starts)])
+        num_bins += len(starts)
+
+    pyramid_meta = dict(meta or {})
+    pyramid_meta.update({'version': PYRAMID_VERSION, 'bin_pixels': BIN_PIXELS, 'levels': levels,
+                         'phenotypes': names, 'num_cells': len(rows), 'num_bins': num_bins})
+
+    pyramid_dir = Path(pyramid_dir)
+    tmp_dir = pyramid_dir.with_name(pyramid_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    np.save(tmp_dir / 'order.npy', rows, allow_pickle=False)
+    for field in FIELDS:
+        np.save(tmp_dir / (field + '.npy'), np.concatenate(bins[field]), allow_pickle=False)
+    with open(tmp_dir / META_NAME, 'w') as f:
+        json.dump(pyramid_meta, f)
+    if pyramid_dir.exists():
+        shutil.rmtree(pyramid_dir)
+    os.replace(tmp_dir, pyramid_dir)
+    return load(pyramid_dir)
+
+
+def read_meta(pyramid_dir):
+    try:
+        with open(Path(pyramid_dir) / META_NAME, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == PYRAMID_VERSION else None
+
+
+def load(pyramid_dir):
+    # Returns the pyramid stored in pyramid_dir, None if there is no usable one
+    meta = read_meta(pyramid_dir)
+    if meta is None:
+        return None
+    pyramid_dir = Path(pyramid_dir)
+    # Empty arrays cannot be memory-mapped
+    mmap_mode = 'r' if meta['num_cells'] > 0 else None
+    try:
+        order = np.load(pyramid_dir / 'order.npy', mmap_mode=mmap_mode, allow_pickle=False)
+        bins = {field: np.load(pyramid_dir / (field + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+                for field in FIELDS}
+    except (OSError, ValueError):
+        return None
+    return CentroidPyramid(order, bins, meta)
+
+
+def _morton(bx, by):
+    # Z-order code of bins, interleaving the bits of their (up to 32 bit) coordinates
+    return _spread(bx) | (_spread(by) << np.uint64(1))
+
+
+def _spread(values):
+    values = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def _first_minimum(values, starts, counts):
+    # Position of the first smallest value of each segment
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64)
+    minimum = np.repeat(np.minimum.reduceat(values, starts), counts)
+    positions = np.flatnonzero(values == minimum)
+    segments = np.searchsorted(starts, positions, side='right') - 1
+    first = np.flatnonzero(np.concatenate(([True], segments[1:] != segments[:-1])))
+    return positions[first]
+
+
+def _most_common(codes, starts, counts, num_codes):
+    # Most common code of each segment (the smallest on ties), -1 where all are missing
+    if len(starts) == 0 or num_codes == 0:
+        return np.full(len(starts), -1, dtype=np.int32)
+    segments = np.repeat(np.arange(len(starts)), counts)
+    known = codes >= 0
+    pairs, pair_counts = np.unique(segments[known] * num_codes + codes[known], return_counts=True)
+    pair_segments = pairs // num_codes
+    # By segment, then highest count, then code: the first pair of each segment wins
+    order = np.lexsort((pairs % num_codes, -pair_counts, pair_segments))
+    pair_segments = pair_segments[order]
+    first = np.concatenate(([True], pair_segments[1:] != pair_segments[:-1]))
+    result = np.full(len(starts), -1, dtype=np.int32)
+    result[pair_segments[first]] = (pairs[order][first] % num_codes).astype(np.int32)
+    return result
@@ -0,0 +1,262 @@
+# Spatial index over cell centroids, stored as plain arrays.
+#
+# Cells are binned into a uniform grid and stored sorted by bin (row-major), so
+# the cells of a row of neighbouring bins are one contiguous slice. On disk the
+# index is a few .npy files that are memory-mapped when opened:
+#   points.npy   x, y of every indexed cell, in bin order
+#   order.npy    the table row of every point
+#   offsets.npy  start of every bin in points/order (CSR layout)
+#   meta.json    grid origin, bin size and shape
+import json
+import math
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+INDEX_VERSION = 1
+META_NAME = 'meta.json'
+# Average number of cells per bin the grid is sized for
+CELLS_PER_BIN = 16
+
+
+class SpatialIndex:
+    """
+    Answers nearest-neighbour, radius and rectangle queries over cell centroids.
+    Results are table rows; cells with missing coordinates are not indexed.
+    """
+
+    def __init__(self, points, order, offsets, meta):
+        self.points = points
+        self.order = order
+        self.offsets = offsets
+        self.meta = meta
+        self.origin = np.array(meta['origin'], dtype=np.float64)
+        self.bin_size = meta['bin_size']
+        self.nx, self.ny = meta['shape']
+
+    def __len__(self):
+        return len(self.order)
+
+    def resident_bytes(self):
+        # Memory-mapped arrays are paged in and out by the OS and are not counted
+        return sum(array.nbytes for array in (self.points, self.order, self.offsets)
+                   if not isinstance(array, np.memmap))
+
+    def nearest(self, points, k=1):
+        """
+        Like BallTree.query: for each of the (m, 2) query points, the distances to
+        and rows of its k nearest cells, each of shape (m, k) and closest first.
+        Where fewer than k cells are indexed, distance is inf and row -1.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        distances = np.full((len(points), k), np.inf)
+        rows = np.full((len(points), k), -1, dtype=np.int64)
+        if len(self) == 0 or len(points) == 0:
+            return distances, rows
+        # All points at once among the cells of the bins around them, the
+        # others (sparse areas, points far from any cell) one at a time
+        done = self._nearest_around(points, k, distances, rows)
+        for i in np.flatnonzero(~done):
+            found_distances, found = self._nearest(points[i, 0], points[i, 1], k)
+            distances[i, :len(found)] = found_distances
+            rows[i, :len(found)] = self.order[found]
+        return distances, rows
+
+    def query_radius(self, x, y, r):
+        # Rows of the cells at most r away from (x, y), in table order
+        candidates = self._candidates(x - r, y - r, x + r, y + r)
+        points = self.points[candidates]
+        inside = (points[:, 0] - x) ** 2 + (points[:, 1] - y) ** 2 <= r * r
+        return np.sort(self.order[candidates[inside]])
+
+    def query_rect(self, x0, y0, x1, y1):
+        # Rows of the cells inside the rectangle [x0, x1] x [y0, y1], in table order
+        candidates = self._candidates(x0, y0, x1, y1)
+        points = self.points[candidates]
+        inside = (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+        return np.sort(self.order[candidates[inside]])
+
+    def _bin(self, x, y):
+        # Grid coordinates of the bin (x, y) falls in, clamped to the grid
+        bx = int(min(max((x - self.origin[0]) // self.bin_size, 0), self.nx - 1))
+        by = int(min(max((y - self.origin[1]) // self.bin_size, 0), self.ny - 1))
+        return bx, by
+
+    def _slices(self, bx0, by0, bx1, by1):
+        # Positions in points/order of the cells in bins [bx0, bx1] x [by0, by1]
+        bx0, bx1 = max(bx0, 0), min(bx1, self.nx - 1)
+        by0, by1 = max(by0, 0), min(by1, self.ny - 1)
+        if bx0 > bx1 or by0 > by1:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(by0, by1 + 1) * self.nx
+        starts = self.offsets[rows + bx0]
+        stops = self.offsets[rows + bx1 + 1]
+        return np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+
+    def _candidates(self, x0, y0, x1, y1):
+        # Positions of the cells in the bins overlapping the box, a superset of the cells in it
+        if len(self) == 0 or x1 < x0 or y1 < y0:
+            return np.empty(0, dtype=np.int64)
+        bx0 = math.floor((x0 - self.origin[0]) / self.bin_size)
+        by0 = math.floor((y0 - self.origin[1]) / self.bin_size)
+        bx1 = math.floor((x1 - self.origin[0]) / self.bin_size)
+        by1 = math.floor((y1 - self.origin[1]) / self.bin_size)
+        return self._slices(bx0, by0, bx1, by1)
+
+    def _nearest_around(self, points, k, distances, rows):
+        # Fills in the k nearest cells among those in the 3 x 3 bins around each
+        # point, returns for which points these are the k nearest of all cells
+        bx = np.clip((points[:, 0] - self.origin[0]) // self.bin_size, 0, self.nx - 1).astype(np.int64)
+        by = np.clip((points[:, 1] - self.origin[1]) // self.bin_size, 0, self.ny - 1).astype(np.int64)
+        lo = np.maximum(bx - 1, 0)
+        hi = np.minimum(bx + 1, self.nx - 1)
+        starts = []
+        stops = []
+        for dy in (-1, 0, 1):
+            row = np.clip(by + dy, 0, self.ny - 1) * self.nx
+            valid = (by + dy >= 0) & (by + dy < self.ny)
+            starts.append(self.offsets[row + lo])
+            stops.append(np.where(valid, self.offsets[row + hi + 1], self.offsets[row + lo]))
+        starts = np.stack(starts, axis=1).ravel()
+        lengths = np.stack(stops, axis=1).ravel() - starts
+        point_of_slice = np.repeat(np.arange(len(points)), 3)
+        # Flattened candidates, with the point each one is a candidate for
+        point_of = np.repeat(point_of_slice, lengths)
+        candidates = ranges(starts, starts + lengths)
+        candidate_points = self.points[candidates]
+        candidate_distances = np.sqrt((candidate_points[:, 0] - points[point_of, 0]) ** 2 +
+                                      (candidate_points[:, 1] - points[point_of, 1]) ** 2)
+        order = np.lexsort((candidate_distances, point_of))
+        point_of = point_of[order]
+        counts = np.bincount(point_of, minlength=len(points))
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank < k
+        distances[point_of[keep], rank[keep]] = candidate_distances[order[keep]]
+        rows[point_of[keep], rank[keep]] = self.order[candidates[order[keep]]]
+
+        # Cells outside the searched bins are at least this far away
+        bound = np.full(len(points), np.inf)
+        for has_bins, distance in ((bx - 1 > 0, points[:, 0] - (self.origin[0] + (bx - 1) * self.bin_size)),
+                                   (bx + 1 < self.nx - 1, self.origin[0] + (bx + 2) * self.bin_size - points[:, 0]),
+                                   (by - 1 > 0, points[:, 1] - (self.origin[1] + (by - 1) * self.bin_size)),
+                                   (by + 1 < self.ny - 1, self.origin[1] + (by + 2) * self.bin_size - points[:, 1])):
+            bound = np.where(has_bins, np.minimum(bound, np.maximum(distance, 0)), bound)
+        wanted = min(k, len(self))
+        return (counts >= wanted) & (distances[:, wanted - 1] <= bound)
+
+    def _nearest(self, x, y, k):
+        # Searches squares of bins of doubling size around (x, y) until no cell
+        # outside the square can be closer than the k-th closest one inside it
+        bx, by = self._bin(x, y)
+        k = min(k, len(self))
+        ring = 0
+        while True:
+            candidates = self._slices(bx - ring, by - ring, bx + ring, by + ring)
+            covers_grid = bx - ring <= 0 and by - ring <= 0 and bx + ring >= self.nx - 1 and by + ring >= self.ny - 1
+            if len(candidates) >= k:
+                points = self.points[candidates]
+                distances = np.sqrt((points[:, 0] - x) ** 2 + (points[:, 1] - y) ** 2)
+                closest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(k)
+                closest = closest[np.argsort(distances[closest], kind='stable')]
+                if covers_grid or distances[closest[-1]] <= self._outside_distance(x, y, bx, by, ring):
+                    return distances[closest], candidates[closest]
+            ring = ring * 2 if ring > 0 else 1
+
+    def _outside_distance(self, x, y, bx, by, ring):
+        # Lower bound of the distance from (x, y) to cells in bins outside the searched square
+        left = self.origin[0] + (bx - ring) * self.bin_size
+        right = self.origin[0] + (bx + ring + 1) * self.bin_size
+        bottom = self.origin[1] + (by - ring) * self.bin_size
+        top = self.origin[1] + (by + ring + 1) * self.bin_size
+        bounds = []
+        if bx - ring > 0:
+            bounds.append(max(x - left, 0))
+        if bx + ring < self.nx - 1:
+            bounds.append(max(right - x, 0))
+        if by - ring > 0:
+            bounds.append(max(y - bottom, 0))
+        if by + ring < self.ny - 1:
+            bounds.append(max(top - y, 0))
+        return min(bounds) if bounds else np.inf
+
+
+def build(x, y, index_dir, meta=None):
+    """
+    Builds the index over the cells at (x, y) and writes it to index_dir. meta is
+    stored along with the grid description.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    x, y = x[rows], y[rows]
+
+    if len(rows) > 0:
+        origin = [float(x.min()), float(y.min())]
+        width, height = float(x.max()) - origin[0], float(y.max()) - origin[1]
+    else:
+        origin, width, height = [0.0, 0.0], 0.0, 0.0
+    area = max(width, 1.0) * max(height, 1.0)
+    bin_size = max(math.sqrt(area * CELLS_PER_BIN / max(len(rows), 1)), 1e-9)
+    nx = int(width // bin_size) + 1
+    ny = int(height // bin_size) + 1
+
+    bx = np.minimum(((x - origin[0]) // bin_size).astype(np.int64), nx - 1)
+    by = np.minimum(((y - origin[1]) // bin_size).astype(np.int64), ny - 1)
+    bins = by * nx + bx
+    sort = np.argsort(bins, kind='stable')
+    offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+    np.cumsum(np.bincount(bins, minlength=nx * ny), out=offsets[1:])
+
+    index_meta = dict(meta or {})
+    index_meta.update({'version': INDEX_VERSION, 'origin': origin, 'bin_size': bin_size, 'shape': [nx, ny],
+                       'num_points': len(rows)})
+
+    index_dir = Path(index_dir)
+    tmp_dir = index_dir.with_name(index_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    np.save(tmp_dir / 'points.npy', np.column_stack((x[sort], y[sort])), allow_pickle=False)
+    np.save(tmp_dir / 'order.npy', rows[sort], allow_pickle=False)
+    np.save(tmp_dir / 'offsets.npy', offsets, allow_pickle=False)
+    with open(tmp_dir / META_NAME, 'w') as f:
+        json.dump(index_meta, f)
+    if index_dir.exists():
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+    return load(index_dir)
+
+
+def read_meta(index_dir):
+    try:
+        with open(Path(index_dir) / META_NAME, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == INDEX_VERSION else None
+
+
+def load(index_dir):
+    # Returns the index stored in index_dir, None if there is no usable one
+    meta = read_meta(index_dir)
+    if meta is None:
+        return None
+    index_dir = Path(index_dir)
+    # Empty arrays cannot be memory-mapped
+    mmap_mode = 'r' if meta['num_points'] > 0 else None
+    try:
+        points = np.load(index_dir / 'points.npy', mmap_mode=mmap_mode, allow_pickle=False)
+        order = np.load(index_dir / 'order.npy', mmap_mode=mmap_mode, allow_pickle=False)
+        offsets = np.load(index_dir / 'offsets.npy', allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    return SpatialIndex(points, order, offsets, meta)
+
+
+def ranges(starts, stops):
+    # Concatenation of arange(start, stop) for every pair, e.g. the positions of the cells of several bins
+    lengths = stops - starts
+    first = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(first - starts, lengths)
@@ -1,4 +1,43 @@
 import sys
+import time
+
+start_time = time.perf_counter()
+
+
+def profile_imports():
+    # Times every module imported for the first time, returns a function printing the slowest ones
+    import builtins
+    import importlib.util
+    original_import = builtins.__import__
+    timings = {}
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        module_name = name
+        if level > 0 and globals:
+            # Relative import
+            module_name = importlib.util.resolve_name('.' * level + name, globals.get('__package__'))
+        if module_name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            timings.setdefault(module_name, time.perf_counter() - start)
+
+    def report(count=20):
+        builtins.__import__ = original_import
+        print('Slowest imports (including the modules they import):')
+        for name, seconds in sorted(timings.items(), key=lambda item: -item[1])[:count]:
+            print('  %6.3fs  %s' % (seconds, name))
+
+    builtins.__import__ = timed_import
+    return report
+
+
+profile_startup = '--profile-startup' in sys.argv
+if profile_startup:
+    sys.argv.remove('--profile-startup')
+    report_imports = profile_imports()
 
 from waitress import serve
 
@@ -19,6 +58,9 @@ if __name__ == '__main__':
         is_docker = False
     app.config['IS_DOCKER'] = is_docker
 
+    if profile_startup:
+        report_imports()
+        print('Startup took %.2fs' % (time.perf_counter() - start_time))
     print('Serving on 0.0.0.0:' + str(port) + ' or http://localhost:' + str(port))
     serve(app, host='0.0.0.0', port=port, max_request_body_size=1073741824000000,
           max_request_header_size=85899345920000)